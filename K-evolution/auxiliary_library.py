@@ -1,11 +1,122 @@
 # In [1]:
 
-import qutip, sys, pickle
+import qutip, sys, os, pickle, hashlib, itertools, warnings
+import concurrent.futures, multiprocessing, contextlib, functools, tracemalloc, io
 import numpy as np
 import scipy.optimize as opt 
 import matplotlib.pyplot as plt
 import time as time
 import scipy.linalg as linalg
+import scipy.sparse as sparse
+import scipy.sparse.linalg
+
+### The Pauli-string algebra and the operator cache / result storage live in their own modules, and are re-exported
+### here.
+from pauli_algebra import popcount, bit_counts, parity, PauliString, PauliSum, pauli_to_qobj, one_body_pauli_ops
+from cache_io import (sparse_data, fingerprint, OperatorCache, cached, ResultSink, StreamingResultWriter, 
+                      StoredStates, StoredResult, load_stored_results)
+
+# In [1b]:
+
+### Stage profiling. A StageProfiler used as a context manager becomes the active profiler, and every 
+### `with profile_stage(name):` block run meanwhile (see spin_chain_ev) adds its wall time, number of calls and, if 
+### track_memory is set, its peak traced memory (tracemalloc, measured over the memory at the start of the stage) 
+### to the profiler's report. callback(name, elapsed, peak_memory) is also called as each stage ends. Without an 
+### active profiler, profile_stage returns a shared null context, so instrumented code costs one global lookup.
+
+active_profiler = None
+no_profiling = contextlib.nullcontext()
+
+def profile_stage(name):
+    if active_profiler is None:
+        return no_profiling
+    return active_profiler.stage(name)
+
+class StageProfiler(object):
+    
+    def __init__(self, track_memory = False, callback = None):
+        self.track_memory = track_memory
+        self.callback = callback
+        self.stats = {}
+        self.stack = []
+        self.previous = []
+        self.started_tracing = False
+    
+    def __enter__(self):
+        global active_profiler
+        self.previous.append(active_profiler)
+        active_profiler = self
+        if self.track_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+        return self
+    
+    def __exit__(self, *exc_info):
+        global active_profiler
+        active_profiler = self.previous.pop()
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+        return False
+    
+    @contextlib.contextmanager
+    def stage(self, name):
+        ### entries: [name, start time, memory at start, peak memory so far]
+        if self.track_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if self.stack:
+                self.stack[-1][3] = max(self.stack[-1][3], peak)
+            tracemalloc.reset_peak()
+            entry = [name, 0., current, current]
+        else:
+            entry = [name, 0., None, None]
+        self.stack.append(entry)
+        entry[1] = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - entry[1]
+            self.stack.pop()
+            peak_memory = None
+            if self.track_memory:
+                entry[3] = max(entry[3], tracemalloc.get_traced_memory()[1])
+                peak_memory = entry[3] - entry[2]
+                if self.stack:
+                    self.stack[-1][3] = max(self.stack[-1][3], entry[3])
+                tracemalloc.reset_peak()
+            self.record(name, elapsed, peak_memory)
+    
+    def record(self, name, elapsed, peak_memory = None):
+        stats = self.stats.setdefault(name, {"calls": 0, "time": 0., "peak memory": None})
+        stats["calls"] += 1; stats["time"] += elapsed
+        if peak_memory is not None:
+            stats["peak memory"] = max(stats["peak memory"] or 0, peak_memory)
+        if self.callback is not None:
+            self.callback(name, elapsed, peak_memory)
+        
+    def report(self):
+        """
+        {stage: {"calls", "total time", "mean time", "peak memory" (bytes, or None)}}, in order of first use.
+        """
+        return {name: {"calls": stats["calls"], "total time": stats["time"], 
+                       "mean time": stats["time"] / stats["calls"], "peak memory": stats["peak memory"]}
+                for name, stats in self.stats.items()}
+
+def with_profiler(func):
+    """
+    Adds a profiler keyword to func (which returns title, ev_parameters, result): the call then runs with that 
+    StageProfiler active, and its report is attached to ev_parameters as "Timing report".
+    """
+    @functools.wraps(func)
+    def profiled_func(*args, profiler = None, **kwargs):
+        if profiler is None:
+            return func(*args, **kwargs)
+        with profiler:
+            with profiler.stage("total"):
+                title, ev_parameters, result = func(*args, **kwargs)
+        ev_parameters["Timing report"] = profiler.report()
+        return title, ev_parameters, result
+    return profiled_func
 
 # In [2]:
 
@@ -97,7 +208,120 @@ def basis_hermitian_check(basis):
 ### All these 3N+1-operators are constructed with a tensor product so that they all act on the full Hilbert space. 
 ### All, but the global identity operator, act non-trivially only on one Hilbert subspace. 
 
-def one_body_spin_ops(size):
+### Memoization of the operator factories below (one_body_spin_ops, all_two_body_spin_ops, two_body_spin_ops, 
+### n_body_basis), keyed on (factory, size, order / build_all). An OperatorMemo used as a context manager becomes the
+### active memo, and each operator set is then built once while it is active (see with_operator_memo, which scopes 
+### one to every spin_chain_ev call, unless one is passed in or already active). Without an active memo, the 
+### factories just build their operators. The memo is a least-recently-used one, bounded by the estimated memory of
+### the stored operators (max_bytes). Factories return fresh lists, but the operators in them are shared.
+
+active_operator_memo = None
+
+def operators_nbytes(ops):
+    if isinstance(ops, qutip.Qobj):
+        data = sparse_data(ops)
+        return data.data.nbytes + data.indices.nbytes + data.indptr.nbytes
+    if isinstance(ops, (list, tuple)):
+        return sum(operators_nbytes(op) for op in ops)
+    return 0
+
+def copy_op_lists(ops):
+    if isinstance(ops, list):
+        return [copy_op_lists(op) for op in ops]
+    if isinstance(ops, tuple):
+        return tuple(copy_op_lists(op) for op in ops)
+    return ops
+
+class OperatorMemo(object):
+    
+    def __init__(self, max_bytes = 2**28):
+        self.max_bytes = max_bytes
+        self.ops = {}; self.order = []; self.nbytes = {}
+        self.previous = []
+    
+    def __enter__(self):
+        global active_operator_memo
+        self.previous.append(active_operator_memo)
+        active_operator_memo = self
+        return self
+    
+    def __exit__(self, *exc_info):
+        global active_operator_memo
+        active_operator_memo = self.previous.pop()
+        return False
+    
+    def get(self, key, builder):
+        if key in self.ops:
+            self.order.remove(key)
+            self.order.append(key)
+            return copy_op_lists(self.ops[key])
+        return self.register(key, builder())
+    
+    def register(self, key, ops):
+        """
+        Stores ops (eg. loaded from an OperatorCache) as the memoized value of key, unless there is one already, and 
+        returns a copy of the memoized value, so that the factories keyed on it are memoized too.
+        """
+        if key in self.ops:
+            return self.get(key, None)
+        self.ops[key] = ops
+        self.nbytes[key] = operators_nbytes(ops)
+        while self.order and sum(self.nbytes.values()) > self.max_bytes:
+            old_key = self.order.pop(0)
+            del self.ops[old_key], self.nbytes[old_key]
+        self.order.append(key)
+        return copy_op_lists(ops)
+    
+    def clear(self):
+        self.ops.clear(); self.order.clear(); self.nbytes.clear()
+
+def memoized_ops(key, builder):
+    if active_operator_memo is None:
+        return builder()
+    return active_operator_memo.get(key, builder)
+
+def register_memoized_ops(key, ops):
+    if active_operator_memo is None:
+        return ops
+    return active_operator_memo.register(key, ops)
+
+def memoized_size(op_list, size):
+    """
+    Returns size if op_list holds the memoized one_body_spin_ops(size) operators (so that the factories may be 
+    memoized on size alone), and None otherwise.
+    """
+    key = ("one_body_spin_ops", size)
+    if active_operator_memo is None or key not in active_operator_memo.ops or len(op_list) != 4:
+        return None
+    memo_list = active_operator_memo.ops[key]
+    if all(len(ops) == len(memo_ops) and all(op is memo_op for op, memo_op in zip(ops, memo_ops))
+           for ops, memo_ops in zip(op_list, memo_list)):
+        return size
+    return None
+
+def with_operator_memo(func):
+    """
+    Adds an operator_memo keyword to func: the call then runs with that OperatorMemo active. By default, the active 
+    memo is kept, or a new one is scoped to the call.
+    """
+    @functools.wraps(func)
+    def memoized_func(*args, operator_memo = None, **kwargs):
+        if operator_memo is None:
+            operator_memo = active_operator_memo if active_operator_memo is not None else OperatorMemo()
+        with operator_memo:
+            return func(*args, **kwargs)
+    return memoized_func
+
+def one_body_spin_ops(size, pauli_strings = False):
+    
+    ### If pauli_strings is set, the operators are returned in the compact Pauli-string form (see PauliString below), 
+    ### with the same list layout. Full matrices are then only built on demand, via pauli_to_qobj.
+    
+    if pauli_strings:
+        return one_body_pauli_ops(size)
+    return memoized_ops(("one_body_spin_ops", size), lambda: build_one_body_spin_ops(size))
+
+def build_one_body_spin_ops(size):
     
     ### Basic, one-site spin operators are constructed.
     
@@ -145,6 +369,12 @@ def spin_dephasing(op_list, size, gamma):
 ### There are N(N+1)/2 different correlators in an N-site spin chain.
 
 def all_two_body_spin_ops(op_list, size):
+    if memoized_size(op_list, size) is not None:
+        return memoized_ops(("two_body_spin_ops", size, True), 
+                            lambda: build_all_two_body_spin_ops(op_list, size))
+    return build_all_two_body_spin_ops(op_list, size)
+
+def build_all_two_body_spin_ops(op_list, size):
     loc_global_id_list, sx_list, sy_list, sz_list = op_list
       
     pauli_four_vec = [loc_global_id_list, sx_list, sy_list, sz_list];
@@ -172,9 +402,17 @@ def all_two_body_spin_ops(op_list, size):
 ### or some subset of these. 
 
 def two_body_spin_ops(op_list, size, build_all = False):
+    if build_all:
+        return all_two_body_spin_ops(op_list, size)
+    if memoized_size(op_list, size) is not None:
+        return memoized_ops(("two_body_spin_ops", size, False), 
+                            lambda: build_two_body_spin_ops(op_list, size, False))
+    return build_two_body_spin_ops(op_list, size, False)
+
+def build_two_body_spin_ops(op_list, size, build_all = False):
     loc_list = []
     if build_all:
-        loc_list = all_two_body_spin_ops(op_list, N)
+        loc_list = all_two_body_spin_ops(op_list, size)
     else: 
         globalid_list, sx_list, sy_list, sz_list = op_list       
         loc_sxsx = []; loc_sysy = []; loc_szsz = [];
@@ -194,14 +432,18 @@ def two_body_spin_ops(op_list, size, build_all = False):
 
 ### This module constructs the Heisenberg Hamiltonian for different types of systems, according to some user-inputed parameters. 
 
-def Heisenberg_Hamiltonian(op_list, chain_type, size, Hamiltonian_paras, closed_bcs = True, visualization = False):
+def Heisenberg_Hamiltonian(op_list, chain_type, size, Hamiltonian_paras, closed_bcs = True, visualization = False,
+                           disorder_seed = None):
     spin_chain_type = ["XX", "XYZ", "XXZ", "XXX", "Anderson"]
     loc_globalid_list, sx_list, sy_list, sz_list = op_list       
           
     H = 0; N = size
     Jx = Hamiltonian_paras[0] * 2 * np.pi #* np.ones(N)
-    h =  Hamiltonian_paras[3] * 2 * np.pi #* np.ones(N)
-    H += sum(-.5* h * sz_list[n] for n in range(N-1)) # Zeeman interaction 
+    if (chain_type == "Anderson"):
+        h = anderson_disorder(Hamiltonian_paras[3], N, disorder_seed) * 2 * np.pi
+    else:
+        h =  Hamiltonian_paras[3] * 2 * np.pi * np.ones(N)
+    H += sum(-.5* h[n] * sz_list[n] for n in range(N-1)) # Zeeman interaction 
     
     if (chain_type in spin_chain_type): 
         if (chain_type == "XX"):
@@ -224,9 +466,9 @@ def Heisenberg_Hamiltonian(op_list, chain_type, size, Hamiltonian_paras, closed_
             H += sum(-.5 * Jx * (sx_list[n] * sx_list[n+1] + sy_list[n] * sy_list[n+1]) 
                      -.5 * Jz * (sz_list[n] * sz_list[n+1]) for n in range(N-1))
             if closed_bcs and N>2: 
-                H += -.5 * Jx * (sx_list[N-1] * sx_list[0] +
-                                 sy_list[N-1] * sy_list[0]) 
-                -.5 * Jz * (sz_list[N-1] * sz_list[0])
+                H += (-.5 * Jx * (sx_list[N-1] * sx_list[0] +
+                                  sy_list[N-1] * sy_list[0]) 
+                      -.5 * Jz * (sz_list[N-1] * sz_list[0]))
         
         elif (chain_type == "XYZ"):
             Jy = Hamiltonian_paras[1] * 2 * np.pi #* np.ones(N)
@@ -235,23 +477,117 @@ def Heisenberg_Hamiltonian(op_list, chain_type, size, Hamiltonian_paras, closed_
                      -.5 * Jy * (sy_list[n] * sy_list[n+1]) 
                      -.5 * Jz * (sz_list[n] * sz_list[n+1]) for n in range(N-1))
             if closed_bcs and N>2: 
-                H += -.5 * Jx * (sx_list[N-1] * sx_list[0])
-                -.5 * Jy * (sy_list[N-1] * sy_list[0]) 
-                -.5 * Jz * (sz_list[N-1] * sz_list[0])
+                H += (-.5 * Jx * (sx_list[N-1] * sx_list[0])
+                      -.5 * Jy * (sy_list[N-1] * sy_list[0]) 
+                      -.5 * Jz * (sz_list[N-1] * sz_list[0]))
                 
         elif (chain_type == "Anderson"):
-            pass
+            ### XX hopping in a random, site-dependent, Zeeman field (see anderson_disorder)
+            H += sum(-.5* Jx *(sx_list[n]*sx_list[n+1] 
+                                 + sy_list[n]*sy_list[n+1]) for n in range(N-1))
+            if closed_bcs and N>2: 
+                H -= .5* Jx *(sx_list[N-1]*sx_list[0] + sy_list[N-1]*sy_list[0])
     else:
         sys.exit("Currently not supported chain type")
               
     if visualization:
-        qutip.hinton(H)
+        qutip.hinton(pauli_to_qobj(H))
+    
+    ### Pauli-string Hamiltonians are checked, and returned, in compact form 
+    
+    if isinstance(H, (PauliString, PauliSum)):
+        H = H.simplify() if isinstance(H, PauliSum) else H
+        H_is_hermitian = H.isherm
+    else:
+        H_is_hermitian = qutip.isherm(H)
         
-    if (qutip.isherm(H)): 
+    if (H_is_hermitian): 
         return H
     else:
         sys.exit("Non-Hermitian Hamiltonian obtained")
 
+### For the Anderson chain, the fourth Hamiltonian parameter sets the on-site disorder. A scalar W is understood as
+### the disorder strength, and the site fields are drawn uniformly from [-W, W]. A list of N values is taken as the 
+### site fields themselves. 
+
+def anderson_disorder(disorder, size, disorder_seed = None):
+    if np.isscalar(disorder):
+        rng = np.random.default_rng(disorder_seed)
+        return rng.uniform(-disorder, disorder, size)
+    disorder = np.asarray(disorder, dtype = float)
+    assert len(disorder) == size, "One disorder value per site is required"
+    return disorder
+
+def site_couplings(coupling, size):
+    ### Broadcasts a uniform coupling to one value per site (or per bond, n -> n+1).
+    if np.isscalar(coupling):
+        return coupling * np.ones(size)
+    coupling = np.asarray(coupling, dtype = float)
+    assert len(coupling) == size, "One coupling per site is required"
+    return coupling
+
+### Sparse counterpart of Heisenberg_Hamiltonian. Instead of adding up products of full-space operators, the bond and 
+### Zeeman terms are written directly as (row, col, value) arrays acting on the computational basis states j = 0...2^N-1:
+###    * sz_n is diagonal, with eigenvalue +1/2 (-1/2) if the bit of site n in j is 0 (1), 
+###    * sx_n sx_m and sy_n sy_m flip both bits, with amplitude 1/4 and -(+)1/4 if the bits are equal (different),
+###    * sz_n sz_m is diagonal, with eigenvalue 1/4 (-1/4) if the bits are equal (different).
+### The conventions are those of Heisenberg_Hamiltonian: the couplings are multiplied by 2 pi, the Zeeman term acts
+### on the first N-1 sites, and the closing bond N-1 -> 0 is only added for closed_bcs and N > 2. Besides scalars, 
+### Hamiltonian_paras may contain one coupling per bond (or one field per site), which is also how the Anderson 
+### disorder is introduced. 
+
+def sparse_Heisenberg_Hamiltonian(chain_type, size, Hamiltonian_paras, closed_bcs = True, qutip_form = True,
+                                  disorder_seed = None):
+    N = size; dim = 2**N
+    states = np.arange(dim)
+    Jx = site_couplings(Hamiltonian_paras[0], N) * 2 * np.pi
+    Jy = site_couplings(Hamiltonian_paras[1], N) * 2 * np.pi
+    Jz = site_couplings(Hamiltonian_paras[2], N) * 2 * np.pi
+    if (chain_type == "Anderson"):
+        h = anderson_disorder(Hamiltonian_paras[3], N, disorder_seed) * 2 * np.pi
+    else:
+        h = site_couplings(Hamiltonian_paras[3], N) * 2 * np.pi
+        
+    ### Couplings (x, y, z) used by each chain type
+    
+    if (chain_type in ["XX", "Anderson"]):
+        Jy = Jx; Jz = np.zeros(N)
+    elif (chain_type == "XXX"):
+        Jy = Jx; Jz = Jx
+    elif (chain_type == "XXZ"):
+        Jy = Jx
+    elif (chain_type != "XYZ"):
+        sys.exit("Currently not supported chain type")
+    
+    bonds = [(n, n+1) for n in range(N-1)]
+    if closed_bcs and N>2:
+        bonds.append((N-1, 0))
+    
+    def site_bits(n):
+        return (states >> (N-1-n)) & 1
+    
+    diag = np.zeros(dim)
+    for n in range(N-1):
+        diag += -.5 * h[n] * .5 * (1 - 2 * site_bits(n))  # Zeeman interaction 
+    
+    rows = [states]; cols = [states]; values = [None]
+    for n, m in bonds:
+        differ = site_bits(n) ^ site_bits(m)
+        diag += -.5 * Jz[n] * .25 * (1 - 2 * differ)
+        off_diag = -.5 * .25 * (Jx[n] + Jy[n] * (2 * differ - 1))
+        non_null = off_diag != 0
+        rows.append((states ^ ((1 << (N-1-n)) | (1 << (N-1-m))))[non_null])
+        cols.append(states[non_null])
+        values.append(off_diag[non_null])
+    values[0] = diag
+    
+    H = sparse.csr_matrix((np.concatenate(values).astype(complex), (np.concatenate(rows), np.concatenate(cols))), 
+                          shape = (dim, dim))
+    H.eliminate_zeros()
+    if qutip_form:
+        H = qutip.Qobj(H, dims = [[2]*N, [2]*N], isherm = True)
+    return H
+
 def Heisenberg_Hamiltonian_tests(spin_ops_list, N):
     start_time = time.time()
     Hamiltonian_paras = [.2, .15, .1, 1.]
@@ -332,7 +668,13 @@ def HS_distance(rho, sigma, rho0, sc_prod):
     
     return sc_prod(rho, sigma, rho0)
 
-def base_orth(ops, rho0, sc_prod, visualization = False, reinforce_reality=False):
+def base_orth(ops, rho0, sc_prod, visualization = False, reinforce_reality=False, vectorized = False):
+    
+    ### vectorized = True orthonormalizes the whole set at once from its Gram matrix (see vectorized_base_orth),
+    ### with the same rank-drop threshold. Only HS_inner_prod_r, HS_inner_prod_t and HSInnerProduct are supported.
+    
+    if vectorized and (isinstance(sc_prod, HSInnerProduct) or sc_prod in (HS_inner_prod_r, HS_inner_prod_t)):
+        return vectorized_base_orth(ops, rho0, sc_prod, reinforce_reality)
     
     if isinstance(ops, dict):
         ops = [ops[key] for key in ops]
@@ -360,11 +702,157 @@ def base_orth(ops, rho0, sc_prod, visualization = False, reinforce_reality=False
                 print("*****************skip", op, " of norm", op_norm)
     return basis
 
+### Vectorized Gram matrices. All the operators are flattened into a single (n, d^2) array, so that the whole matrix 
+### of HS_inner_prod_t / HS_inner_prod_r products is obtained from a couple of matrix products:
+###       tr(rho0 A^dag B)         = sum_lm conj(A)_lm (B rho0)_lm,
+###       .5 tr(rho0 {A^dag, B})   = .5 sum_lm conj(A)_lm (B rho0 + rho0 B)_lm.
+### rho0 is validated once per Gram matrix, instead of once per pair of operators. 
+
+def flatten_ops(ops):
+    ### dictionaries and lists of lists of operators are turned into plain lists, as in base_orth
+    if isinstance(ops, dict):
+        ops = [ops[key] for key in ops]
+    if isinstance(ops[0], list):
+        ops = [op for op1l in ops for op in op1l]
+    return ops
+
+def stack_ops(ops):
+    return np.array([op.full() for op in flatten_ops(ops)])
+
+def stacked_gram_matrix(ops1, ops2, rho0_array, symmetrized = True):
+    ### ops1, ops2: (n, d, d) and (m, d, d) arrays. rho0_array: (d, d) array.
+    n, dim = ops1.shape[:2]; m = ops2.shape[0]
+    ops2_rho0 = (ops2.reshape(m * dim, dim) @ rho0_array).reshape(m, dim * dim)
+    if symmetrized:
+        rho0_ops2 = (rho0_array @ ops2.transpose(1, 0, 2).reshape(dim, m * dim)).reshape(dim, m, dim)
+        ops2_rho0 = .5 * (ops2_rho0 + rho0_ops2.transpose(1, 0, 2).reshape(m, dim * dim))
+    return ops1.reshape(n, dim * dim).conj() @ ops2_rho0.T
+
+def gram_matrix(ops, rho0, sc_prod, ops2 = None):
+    """
+    Returns the matrix G_ij = sc_prod(ops[i], ops2[j], rho0) (ops2 = ops by default).
+    """
+    if isinstance(sc_prod, HSInnerProduct):
+        return sc_prod.gram(ops, ops2)
+    if sc_prod not in (HS_inner_prod_r, HS_inner_prod_t):
+        return np.array([[sc_prod(op1, op2, rho0) for op2 in (ops if ops2 is None else ops2)] for op1 in ops])
+    return HSInnerProduct(rho0, sc_prod, flatten_ops(ops)[0].dims).gram(ops, ops2)
+
+### Inner product bound to a fixed reference state. HS_inner_prod_r / HS_inner_prod_t validate rho0 (hermiticity, 
+### trace and a Cholesky factorization) on every call; here rho0 is validated once and cached as a dense array. 
+### Instances are called as sc_prod(op1, op2, rho0), so they can be passed anywhere sc_prod is accepted: the rho0
+### argument is only kept for signature compatibility, and must be the bound reference state (or None).
+
+class HSInnerProduct(object):
+    
+    def __init__(self, rho0, sc_prod = HS_inner_prod_r, dims = None):
+        assert sc_prod in (HS_inner_prod_r, HS_inner_prod_t), "Only HS_inner_prod_r and HS_inner_prod_t are supported"
+        self.sc_prod = sc_prod
+        self.symmetrized = sc_prod is HS_inner_prod_r
+        if rho0 is None:
+            assert dims is not None, "dims are required for the maximally mixed reference state"
+            dim = int(np.prod(dims[0]))
+            self.rho0 = None; self.dims = dims
+            self.rho0_array = np.identity(dim)/dim
+        else:
+            assert is_density_op(rho0, verbose=True), "rho0 is not a density op"
+            self.rho0 = rho0; self.dims = rho0.dims
+            self.rho0_array = rho0.full()
+    
+    @staticmethod
+    def sparse_form(op):
+        if isinstance(op, qutip.Qobj):
+            return sparse_data(op)
+        if isinstance(op, (PauliString, PauliSum)):
+            return op.sparse()
+        return sparse.csr_matrix(op)
+    
+    def is_bound_to(self, rho0):
+        if rho0 is self.rho0:
+            return True
+        rho0_array = rho0.full() if isinstance(rho0, qutip.Qobj) else np.asarray(rho0)
+        return rho0_array.shape == self.rho0_array.shape and np.array_equal(rho0_array, self.rho0_array)
+    
+    def __call__(self, op1, op2, rho0 = None):
+        if rho0 is not None and not self.is_bound_to(rho0):
+            raise ValueError("HSInnerProduct called with a reference state other than the one it is bound to")
+        return self.inner(op1, op2)
+    
+    def inner(self, op1, op2):
+        op1 = self.sparse_form(op1); op2 = self.sparse_form(op2)
+        result = op1.conj().multiply(op2 @ self.rho0_array).sum()
+        if self.symmetrized:
+            result = .5 * (result + op1.conj().multiply(self.rho0_array @ op2).sum())
+        return result
+    
+    def norm(self, op):
+        return np.sqrt(abs(self.inner(op, op)))
+    
+    def gram(self, ops, ops2 = None):
+        stacked_ops1 = stack_ops(ops)
+        stacked_ops2 = stacked_ops1 if ops2 is None else stack_ops(ops2)
+        return stacked_gram_matrix(stacked_ops1, stacked_ops2, self.rho0_array, self.symmetrized)
+    
+    def coeffs(self, basis, K):
+        ### sc_prod(b, K, rho0) for every b in the basis
+        return self.gram(basis, [K])[:, 0]
+
+
+### Batched Gram-Schmidt. The sequential procedure of base_orth is reproduced on the Gram matrix of the normalized
+### operators: the Cholesky factor L of the Gram matrix of the accepted operators is grown one row at a time, 
+### alpha = L^-1 G[kept, i] being the projections of the i-th operator on the current orthonormal basis. Operators 
+### with a residual norm sqrt(1 - |alpha|^2) below 1e-5 are dropped, as in base_orth. The orthonormal basis is 
+### then L^-1 applied to the stacked operators, and a second Cholesky pass on its own Gram matrix removes the 
+### round-off amplified by nearly dependent operators. 
+
+def orthonormalizing_coeffs(gram, reinforce_reality = False, tol = 1.e-5):
+    if reinforce_reality:
+        gram = gram.real
+    norms = np.sqrt(abs(np.diag(gram)))
+    kept = []; L = np.zeros((0, 0), dtype = gram.dtype)
+    for i in range(len(gram)):
+        if norms[i] < 1e-12:
+            continue
+        column = gram[kept, i]/(norms[kept] * norms[i])
+        alpha = linalg.solve_triangular(L, column, lower = True) if kept else column
+        residual = np.sqrt(max(1. - np.vdot(alpha, alpha).real, 0.))
+        if residual > tol:
+            L = np.block([[L, np.zeros((len(kept), 1))], [alpha.conj()[np.newaxis, :], np.array([[residual]])]])
+            kept.append(i)
+    assert kept, "All the operators have a null norm"
+    coeffs = linalg.solve_triangular(L, np.identity(len(kept)), lower = True) / norms[kept]
+    return coeffs, kept
+
+def vectorized_base_orth(ops, rho0, sc_prod, reinforce_reality = False):
+    ops = flatten_ops(ops)
+    dims = ops[0].dims
+    stacked_ops = stack_ops(ops); n, dim = stacked_ops.shape[:2]
+    if not isinstance(sc_prod, HSInnerProduct):
+        sc_prod = HSInnerProduct(rho0, sc_prod, dims)
+    rho0_array = sc_prod.rho0_array; symmetrized = sc_prod.symmetrized
+    
+    coeffs, kept = orthonormalizing_coeffs(stacked_gram_matrix(stacked_ops, stacked_ops, rho0_array, symmetrized), 
+                                           reinforce_reality)
+    basis_ops = (coeffs.conj() @ stacked_ops[kept].reshape(len(kept), dim * dim)).reshape(len(kept), dim, dim)
+    gram = stacked_gram_matrix(basis_ops, basis_ops, rho0_array, symmetrized)
+    if reinforce_reality:
+        gram = gram.real
+    L = linalg.cholesky(.5 * (gram + gram.conj().T), lower = True)
+    basis_ops = linalg.solve_triangular(L.conj(), basis_ops.reshape(len(kept), dim * dim), lower = True)
+    return [qutip.Qobj(op.reshape(dim, dim), dims = dims) for op in basis_ops]
+
 # In [7]: 
 
 natural = tuple('123456789')
 
 def n_body_basis(op_list, gr, N):
+    ### the one-body operators may belong to a chain of a different size than N (see max_ent_basis)
+    size = len(op_list[1])
+    if (isinstance(gr,int) and str(gr) in natural and memoized_size(op_list, size) is not None):
+        return memoized_ops(("n_body_basis", size, gr), lambda: build_n_body_basis(op_list, gr, N))
+    return build_n_body_basis(op_list, gr, N)
+
+def build_n_body_basis(op_list, gr, N):
     basis = []
     globalid_list, sx_list, sy_list, sz_list = op_list       
         
@@ -373,27 +861,82 @@ def n_body_basis(op_list, gr, N):
             if (gr == 1):
                 basis = globalid_list + sx_list + sy_list + sz_list
             elif (gr > 1):
-                basis = [op1*op2 for op1 in n_body_basis(op_list, gr-1, N) for op2 in n_body_basis(op_list, 1, N)]
+                one_body_basis = n_body_basis(op_list, 1, N)
+                basis = [op1*op2 for op1 in n_body_basis(op_list, gr-1, N) for op2 in one_body_basis]
         except Exception as ex:
             basis = None
             print(ex)
     return basis
 
-def max_ent_basis(op_list, op_basis_order_is_two, N, rho0, sc_prod):
+def max_ent_basis(op_list, op_basis_order_is_two, N, rho0, sc_prod, vectorized = True):
     if (op_basis_order_is_two):
-        basis = base_orth(n_body_basis(op_list, 2, N), rho0, sc_prod, False)  ## two-body max ent basis
+        basis = base_orth(n_body_basis(op_list, 2, N), rho0, sc_prod, False, 
+                          vectorized = vectorized)  ## two-body max ent basis
         a = "two"
     else: 
         lista_ampliada = []
-        for i in range(len(n_body_basis(op_list, 1, N))):
-            lista_ampliada.append(qutip.tensor(n_body_basis(op_list, N,1)[i], qutip.qeye(2)))
-        basis = base_orth(lista_ampliada, rho0, sc_prod, False) ## one-body max-ent basis
+        one_body_basis = n_body_basis(op_list, 1, N)
+        n_body_ops = n_body_basis(op_list, N, 1)
+        for i in range(len(one_body_basis)):
+            lista_ampliada.append(qutip.tensor(n_body_ops[i], qutip.qeye(2)))
+        basis = base_orth(lista_ampliada, rho0, sc_prod, False, vectorized = vectorized) ## one-body max-ent basis
         a = "one"
     print(a + "-body operator chosen")
     return basis
 
 # In [8]:
 
+### For gr = 1, K = sum_n,m coeffs[n][m] one_body_spin_ops(N)[n][m] is a sum of single-site terms, and exp(K)/Z is 
+### the tensor product of the normalized 2x2 exponentials exp(sum_a coeffs[a][k] s_a) of every site k (the identity
+### terms only change Z). ProductState keeps the factors, and expands them into the 2^N x 2^N state only on demand.
+
+class ProductState(object):
+    
+    def __init__(self, factors):
+        self.factors = [np.asarray(factor, dtype = complex) for factor in factors]
+        self.dims = [[len(factor) for factor in self.factors]] * 2
+        
+    def tr(self):
+        return np.prod([np.trace(factor) for factor in self.factors]).real
+    
+    def full(self):
+        result = np.ones((1, 1), dtype = complex)
+        for factor in self.factors:
+            result = np.kron(result, factor)
+        return result
+    
+    def to_qobj(self):
+        return qutip.tensor([qutip.Qobj(factor) for factor in self.factors])
+    
+    def eigensystems(self):
+        return [HermitianEigensystem(factor) for factor in self.factors]
+    
+    def eigenvalues(self):
+        """
+        The d eigenvalues of the state, products of those of the factors, in the tensor order of the basis states.
+        """
+        evals = np.ones(1)
+        for eigsys in self.eigensystems():
+            evals = np.kron(evals, eigsys.evals)
+        return evals
+    
+    def log(self):
+        """
+        log(rho) = sum_k I x .. x log(rho_k) x .. x I
+        """
+        logs = [logM(factor) for factor in self.factors]
+        identities = [qutip.qeye(len(factor)) for factor in self.factors]
+        return sum(qutip.tensor(identities[:k] + [qutip.Qobj(logs[k])] + identities[k+1:]) 
+                   for k in range(len(self.factors)))
+
+def product_max_ent_state(coeffs, N):
+    local_ops = [.5*qutip.sigmax().full(), .5*qutip.sigmay().full(), .5*qutip.sigmaz().full()]
+    factors = []
+    for k in range(N):
+        factor = expM(sum(coeffs[a+1][k] * local_ops[a] for a in range(3)))
+        factors.append(factor / np.trace(factor).real)
+    return ProductState(factors)
+
 def n_body_max_ent_state(op_list, gr, N, coeffs = list, build_all = True, visualization = False):
     K = 0; rho_loc = 0;
     loc_globalid = qutip.tensor([qutip.qeye(2) for k in range(N)]) 
@@ -402,30 +945,26 @@ def n_body_max_ent_state(op_list, gr, N, coeffs = list, build_all = True, visual
     
     if (gr == 1):
         try:
-            K += sum(coeffs[n][m] *  one_body_spin_ops(N)[n][m] 
-                                    for n in range(len(one_body_spin_ops(N)))
-                                    for m in range(len(one_body_spin_ops(N)[n]))
-                   ) 
-            K += 10**-6 * loc_globalid
+            rho_loc = product_max_ent_state(coeffs, N).to_qobj()
         except Exception as exme1:
             print(exme1, "Max-Ent 1 Failure")
             raise exme1
     elif (gr == 2): 
         try:
-            K += sum(coeffs[n][m] * two_body_spin_ops(op_list, N, build_all)[n][m] 
-                    for n in range(len(two_body_spin_ops(op_list, N, build_all)))
-                    for m in range(len(two_body_spin_ops(op_list, N, build_all)[n]))
+            two_body_ops = two_body_spin_ops(op_list, N, build_all)
+            K += sum(coeffs[n][m] * two_body_ops[n][m] 
+                    for n in range(len(two_body_ops))
+                    for m in range(len(two_body_ops[n]))
                    )
             K += 10**-6 * loc_globalid
         except Exception as exme2:
             print(exme2, "Max-Ent 2 Failure")
             raise exme2
+        rho_loc = K.expm()
+        rho_loc = rho_loc/rho_loc.tr()
     else:
         print('gr must be either 1 or 2')
     
-    rho_loc = K.expm()
-    rho_loc = rho_loc/rho_loc.tr()
-    
     assert is_density_op(rho_loc, verbose=True), "rho_loc is not a density operator"
         
     if visualization: 
@@ -434,8 +973,23 @@ def n_body_max_ent_state(op_list, gr, N, coeffs = list, build_all = True, visual
 
 # In [9]: 
 
+### The non-Gaussian states x |psi0><psi0| + (1-x) x/N I (normalized) are a rank-one projector over an identity floor,
+### which LowRankState represents exactly. With lazy = True, initial_state returns these factorized (ProductState, 
+### for gr = 1) or low-rank (LowRankState) forms instead of the expanded density matrices.
+
+def low_rank_mixed_state(psi0, x, N):
+    state = LowRankState.from_ket(psi0.unit(), weight = x, floor = (1-x) * x/N)
+    norm = state.tr()
+    state.weights = state.weights / norm; state.floor = state.floor / norm
+    return state
+
 def initial_state(op_list, N = 1, gaussian = True, gr = 1, x = .5, coeffs = list, psi0 = qutip.Qobj,
-                  build_all = False, visualization=False):
+                  build_all = False, visualization=False, lazy = False):
+    
+    if lazy and gaussian and gr == 1:
+        return product_max_ent_state(coeffs, N)
+    if lazy and not gaussian and qutip.isket(psi0):
+        return low_rank_mixed_state(psi0, x, N)
     
     loc_globalid = qutip.tensor([qutip.qeye(2) for k in range(N)]) 
     if gaussian: 
@@ -456,13 +1010,14 @@ def initial_state(op_list, N = 1, gaussian = True, gr = 1, x = .5, coeffs = list
 
 # In [10]: 
 
-def choose_initial_state_type(op_list, N, build_all, x, gaussian, gr):
+def choose_initial_state_type(op_list, N, build_all, x, gaussian, gr, lazy = False):
     
     if (gaussian and gr == 1):
+        ### one coefficient per site for each of the sx, sy, sz lists
         a = len(op_list)
-        b = len(op_list[0])
+        b = max(len(ops) for ops in op_list)
         coeffs_me1_gr1 = 10**-2.5 * np.full((a,b), 1)
-        rho0 = initial_state(op_list, N, True, 1, None, coeffs_me1_gr1, None, build_all, False)
+        rho0 = initial_state(op_list, N, True, 1, None, coeffs_me1_gr1, None, build_all, False, lazy)
         statement = "One-body Gaussian"
         
     elif(gaussian and gr == 2):
@@ -470,7 +1025,7 @@ def choose_initial_state_type(op_list, N, build_all, x, gaussian, gr):
         b = len(all_two_body_spin_ops(op_list, N)[0])
 
         coeffs_me2_gr2 = 10**-3 * np.full((a,b),1.)
-        rho0 = initial_state(op_list, N, True, 2, None, coeffs_me2_gr2, None, build_all, False)
+        rho0 = initial_state(op_list, N, True, 2, None, coeffs_me2_gr2, None, build_all, False, lazy)
         statement = "Two-body Gaussian"
              
     elif(not gaussian):
@@ -480,7 +1035,7 @@ def choose_initial_state_type(op_list, N, build_all, x, gaussian, gr):
             psi1_list.append(qutip.basis(2,1))
 
         psi0 = qutip.tensor(psi1_list)
-        rho0 = initial_state(op_list, N, False, None, .5, None, psi0, build_all, False)
+        rho0 = initial_state(op_list, N, False, None, .5, None, psi0, build_all, False, lazy)
         statement = "Non Gaussian"
       
     if gaussian:
@@ -490,72 +1045,113 @@ def choose_initial_state_type(op_list, N, build_all, x, gaussian, gr):
 
 # In [12]: 
 
-def logM(rho, svd = True):
+### Hermitian matrix-function kernel. f(A) = U f(E) U^dag, with A = U E U^dag from a single linalg.eigh call, 
+### which is valid for any Hermitian A (the SVD form U Sigma U^dag only holds for positive matrices) and several
+### times cheaper than a full SVD. Several functions of the same matrix (eg. its log and its square root) can 
+### share one decomposition by calling the methods of a single HermitianEigensystem.
+
+class HermitianEigensystem(object):
+    
+    def __init__(self, op):
+        if isinstance(op, qutip.Qobj):
+            self.qutip_form = True
+            self.dims = op.dims
+            op = op.full()
+        else:
+            self.qutip_form = False
+            self.dims = None
+        op = np.asarray(op)
+        self.evals, self.evecs = linalg.eigh(.5 * (op + op.conj().T))
+    
+    def is_positive(self):
+        return self.evals[0] > 0
+    
+    def apply(self, func):
+        result = (self.evecs * func(self.evals)) @ self.evecs.conj().T
+        if self.qutip_form:
+            result = qutip.Qobj(result, dims = self.dims)
+        return result
+    
+    def log(self):
+        assert self.is_positive(), "Non positive-defined input matrix"
+        return self.apply(np.log)
+    
+    def sqrt(self):
+        assert self.evals[0] > -1e-12, "Non positive-defined input matrix"
+        return self.apply(lambda evals: np.sqrt(abs(evals)))
+    
+    def expm(self, shift = 0.):
+        return self.apply(lambda evals: np.exp(evals - shift))
+    
+    def power(self, p):
+        assert self.is_positive(), "Non positive-defined input matrix"
+        return self.apply(lambda evals: evals**p)
+
+def batched_matrix_function(ops, func):
+    """
+    Applies func to a stack of Hermitian matrices, (m, d, d), with one batched eigh call.
+    """
+    ops = np.asarray(ops)
+    evals, evecs = np.linalg.eigh(.5 * (ops + ops.conj().transpose(0, 2, 1)))
+    return (evecs * func(evals)[:, np.newaxis, :]) @ evecs.conj().transpose(0, 2, 1)
+
+def expM(op):
+    """
+    Evaluates the exponential of a Hermitian matrix
+    """
+    return HermitianEigensystem(op).expm()
+
+def logM(rho, svd = False):
     """
     Evaluates the logarithm of a positive matrix rho
     """
+    if not svd:
+        return HermitianEigensystem(rho).log()
+    
     assert ev_checks(rho), "Non positive-defined input matrix"
     
     if isinstance(rho, qutip.Qobj):
         qutip_form = True
         dims = rho.dims
+        rho = rho.full()
     else:
         qutip_form = False        
 
-    if svd:            
-        if qutip_form:
-            rho = rho.full()
-        U, Sigma, Vdag = linalg.svd(rho, full_matrices = False)
-        matrix_log = U @ np.diag(np.log(Sigma)) @ U.conj().transpose() 
-        #matrix_log = qutip.Qobj(U) * qutip.Qobj(np.diag(np.log(Sigma))) * qutip.Qobj(np.array(Vdag))
-    else: 
-        if qutip_form:
-            eigvals, eigvecs = rho.eigenstates()
-            matrix_log = sum([np.log(vl)*vc*vc.dag() for vl, vc in zip(eigvals, eigvecs)]) 
-        else:
-            rho = rho.full()
-            eigvals, eigvecs = linalg.eigh(rho)
-            return evecs @ np.array([np.log(ev)*np.array(f) for ev, f in zip(evals, evecs.transpose().conj())])
+    U, Sigma, Vdag = linalg.svd(rho, full_matrices = False)
+    matrix_log = U @ np.diag(np.log(Sigma)) @ U.conj().transpose() 
+    #matrix_log = qutip.Qobj(U) * qutip.Qobj(np.diag(np.log(Sigma))) * qutip.Qobj(np.array(Vdag))
     
     if qutip_form:
         matrix_log = qutip.Qobj(matrix_log, dims)
     return matrix_log
 
 
-def sqrtM(rho, svd = True):
+def sqrtM(rho, svd = False):
     """
     Evaluates the square root of a positive matrix rho
     """
+    if not svd:
+        return HermitianEigensystem(rho).sqrt()
+    
     assert ev_checks(rho), "Non positive-defined input matrix"
     
     if isinstance(rho, qutip.Qobj):
         qutip_form = True
         dims = rho.dims
+        rho = rho.full()
     else:
         qutip_form = False
 
-    if svd:
-        if qutip_form:
-            rho = rho.full()
-        U, Sigma, Vdag = linalg.svd(rho, full_matrices = False)
-        matrix_log = U @ np.diag((Sigma)**.5) @ U.conj().transpose() 
-        #matrix_log = qutip.Qobj(U) * qutip.Qobj(np.diag(np.log(Sigma))) * qutip.Qobj(np.array(Vdag))
-    else: 
-        if qutip_form:
-            eigvals, eigvecs = rho.eigenstates()
-            matrix_log = sum([(vl**.5)*vc*vc.dag() for vl, vc in zip(eigvals, eigvecs)]) 
-        else:
-            rho = rho.full()
-            eigvals, eigvecs = linalg.eigh(rho)
-            return evecs @ np.array([(ev**.5)*np.array(f) for ev, f in zip(evals, evecs.transpose().conj())])
+    U, Sigma, Vdag = linalg.svd(rho, full_matrices = False)
+    matrix_sqrt = U @ np.diag((Sigma)**.5) @ U.conj().transpose() 
     
     if qutip_form:
-        matrix_log = qutip.Qobj(matrix_log, dims)
-    return matrix_log
+        matrix_sqrt = qutip.Qobj(matrix_sqrt, dims)
+    return matrix_sqrt
 
 
 
-def bures(rho, sigma, svd = True):
+def bures(rho, sigma, svd = False):
     """
     Evaluates the Bures metric between two states. 
     """
@@ -563,7 +1159,11 @@ def bures(rho, sigma, svd = True):
     assert is_density_op(sigma), "sigma is not a density operator"
     
     sqrt_sigma = sqrtM(sigma.full(), svd=svd)
-    fidelity = sqrtM((sqrt_sigma @ rho.full()  @sqrt_sigma),svd=True).trace().real
+    if svd:
+        fidelity = sqrtM((sqrt_sigma @ rho.full()  @sqrt_sigma),svd=True).trace().real
+    else:
+        ### tr sqrt(M) only needs the eigenvalues of M
+        fidelity = np.sqrt(abs(linalg.eigvalsh(sqrt_sigma @ rho.full() @ sqrt_sigma))).sum()
 
     assert abs(fidelity.imag)<1.e-10, f"complex fidelity? fidelity={fidelity}"
     fidelity = fidelity.real
@@ -575,31 +1175,261 @@ def bures(rho, sigma, svd = True):
     return  np.arccos(fidelity)/np.pi
     
 
+### Distances along trajectories. rhos and sigmas are lists of states (Qobj or arrays), (m, d, d) arrays or 
+### StoredStates. Either one may also be a single state, shared by all the time points, whose decomposition is 
+### then computed once. The per-time work runs over chunks of `chunk` states with batched eigh calls, optionally 
+### spread over `workers` threads (numpy releases the GIL in eigh), and no input is re-validated.
+
+def stack_states(states):
+    if isinstance(states, StoredStates):
+        return np.asarray(states.states)
+    if isinstance(states, qutip.Qobj):
+        return states.full()[np.newaxis]
+    if isinstance(states, np.ndarray):
+        return states if states.ndim == 3 else states[np.newaxis]
+    return np.array([state.full() if hasattr(state, "full") else np.asarray(state) for state in states])
+
+def map_chunks(func, m, chunk = 64, workers = None):
+    chunks = [slice(k, min(k + chunk, m)) for k in range(0, m, chunk)]
+    if workers is None or workers < 2 or len(chunks) < 2:
+        return np.concatenate([func(window) for window in chunks])
+    with concurrent.futures.ThreadPoolExecutor(max_workers = workers) as pool:
+        return np.concatenate(list(pool.map(func, chunks)))
+
+def paired_chunk(states, window):
+    ### a shared (1, d, d) state is broadcast over the chunk
+    return states if len(states) == 1 else states[window]
+
+def bures_series(rhos, sigmas, chunk = 64, workers = None):
+    rhos = stack_states(rhos); sigmas = stack_states(sigmas)
+    m = max(len(rhos), len(sigmas))
+    if len(sigmas) == 1:
+        sqrt_sigmas = sqrtM(sigmas[0])[np.newaxis]
+    elif len(rhos) == 1:
+        ### the fidelity is symmetric, so the shared state takes the square root
+        rhos, sigmas = sigmas, rhos
+        sqrt_sigmas = sqrtM(sigmas[0])[np.newaxis]
+    else:
+        sqrt_sigmas = None
+    def chunk_fidelity(window):
+        sqrt_sigma = (paired_chunk(sqrt_sigmas, window) if sqrt_sigmas is not None else
+                      batched_matrix_function(sigmas[window], lambda evals: np.sqrt(abs(evals))))
+        M = sqrt_sigma @ paired_chunk(rhos, window) @ sqrt_sigma
+        return np.sqrt(abs(np.linalg.eigvalsh(.5 * (M + M.conj().transpose(0, 2, 1))))).sum(axis = 1)
+    fidelity = map_chunks(chunk_fidelity, m, chunk, workers)
+    return np.arccos(np.clip(fidelity, 0., 1.))/np.pi
+
+def rel_entropy_series(rhos, sigmas, chunk = 64, workers = None):
+    rhos = stack_states(rhos); sigmas = stack_states(sigmas)
+    m = max(len(rhos), len(sigmas))
+    log_sigmas = logM(sigmas[0])[np.newaxis] if len(sigmas) == 1 else None
+    if len(rhos) == 1:
+        p = linalg.eigvalsh(rhos[0]); p = p[p > 1e-14]
+        neg_entropies = np.full(m, (p * np.log(p)).sum())
+    else:
+        p = np.linalg.eigvalsh(.5 * (rhos + rhos.conj().transpose(0, 2, 1)))
+        neg_entropies = np.where(p > 1e-14, p * np.log(np.where(p > 1e-14, p, 1.)), 0.).sum(axis = 1)
+    def chunk_cross_entropy(window):
+        log_sigma = (paired_chunk(log_sigmas, window) if log_sigmas is not None else 
+                     batched_matrix_function(sigmas[window], np.log))
+        shape = (window.stop - window.start,) + log_sigma.shape[1:]
+        ### tr(rho log sigma) = sum_kl rho_kl (log sigma)_lk
+        return np.einsum("kij,kji->k", np.broadcast_to(paired_chunk(rhos, window), shape), 
+                         np.broadcast_to(log_sigma, shape)).real
+    return neg_entropies - map_chunks(chunk_cross_entropy, m, chunk, workers)
+
+def trace_distance_series(rhos, sigmas, chunk = 64, workers = None):
+    rhos = stack_states(rhos); sigmas = stack_states(sigmas)
+    m = max(len(rhos), len(sigmas))
+    def chunk_distance(window):
+        delta = paired_chunk(rhos, window) - paired_chunk(sigmas, window)
+        return .5 * abs(np.linalg.eigvalsh(.5 * (delta + delta.conj().transpose(0, 2, 1)))).sum(axis = 1)
+    return map_chunks(chunk_distance, m, chunk, workers)
+
 # In [13]: 
 
 def proj_op(K, basis, rho0, sc_prod):
+    if isinstance(basis, BasisProjector):
+        return basis(K)
     return sum([sc_prod(b, K,rho0) * b for b in basis])
 
-def rel_entropy(rho, sigma, svd = True):
-    assert  ev_checks(rho), "rho is not positive"
-    assert  ev_checks(sigma), "sigma is not positive"
+### Projector onto the span of an orthonormal basis, built once per (basis, rho0). The coefficients sc_prod(b_i, K) 
+### are linear functionals of K, tr(D_i^T K), with the rho0-weighted duals 
+###         D_i = rho0 b_i^dag                           (HS_inner_prod_t),
+###         D_i = .5 (rho0 b_i^dag + b_i^dag rho0)       (HS_inner_prod_r).
+### With the basis and the duals stacked as (n, d^2) arrays, the coefficient vector is one matrix-vector product, 
+### and the projected operator is another one. 
+
+class BasisProjector(object):
+    
+    def __init__(self, basis, rho0, sc_prod):
+        basis = flatten_ops(basis)
+        self.dims = basis[0].dims
+        if not isinstance(sc_prod, HSInnerProduct):
+            sc_prod = HSInnerProduct(rho0, sc_prod, self.dims)
+        self.sc_prod = sc_prod
+        stacked_basis = stack_ops(basis); n, dim = stacked_basis.shape[:2]
+        self.dim = dim
+        self.basis = stacked_basis.reshape(n, dim * dim)
+        
+        ### (rho0 b^dag)^T = conj(b) rho0^T and (b^dag rho0)^T = rho0^T conj(b) 
+        rho0_T = sc_prod.rho0_array.T
+        conj_basis = stacked_basis.conj()
+        duals = (conj_basis.reshape(n * dim, dim) @ rho0_T).reshape(n, dim * dim)
+        if sc_prod.symmetrized:
+            left = (rho0_T @ conj_basis.transpose(1, 0, 2).reshape(dim, n * dim)).reshape(dim, n, dim)
+            duals = .5 * (duals + left.transpose(1, 0, 2).reshape(n, dim * dim))
+        self.duals = duals
+    
+    def __len__(self):
+        return len(self.basis)
+    
+    def coeffs(self, K):
+        if isinstance(K, qutip.Qobj):
+            K = K.full()
+        return self.duals @ np.asarray(K).ravel()
+    
+    def from_coeffs(self, coeffs):
+        return qutip.Qobj((np.asarray(coeffs) @ self.basis).reshape(self.dim, self.dim), dims = self.dims)
+    
+    def __call__(self, K, coeffs_only = False):
+        coeffs = self.coeffs(K)
+        if coeffs_only:
+            return coeffs
+        return self.from_coeffs(coeffs)
+
+
+### Fused projection onto the max-ent manifold. Given rho (or directly its logarithm), the generator log(rho) is 
+### projected onto the basis, and the projected state exp(K)/tr exp(K) is evaluated from a single eigendecomposition
+### of the projected generator K, which also provides the shift (its largest eigenvalue) and the normalization. 
+### Besides the state, the coefficient vector phi of K and the log of the projected state, K - log(tr exp(K)),
+### are returned. 
+
+def maxent_projection_step(rho, projector, log_rho = None):
+    with profile_stage("logM"):
+        if log_rho is None:
+            log_rho = logM(rho)
+    with profile_stage("proj_op"):
+        phi = projector.coeffs(log_rho)
+        K = (phi @ projector.basis).reshape(projector.dim, projector.dim)
+    with profile_stage("expm"):
+        K_eigensystem = HermitianEigensystem(K)
+        evals = K_eigensystem.evals
+        weights = np.exp(evals - evals[-1])
+        log_Z = evals[-1] + np.log(weights.sum())
+        sigma = (K_eigensystem.evecs * (weights/weights.sum())) @ K_eigensystem.evecs.conj().T
+    log_sigma = K - log_Z * np.identity(projector.dim)
+    return (qutip.Qobj(sigma, dims = projector.dims), phi, qutip.Qobj(log_sigma, dims = projector.dims))
+
+
+def rel_entropy(rho, sigma, svd = False):
+    if svd:
+        assert  ev_checks(rho), "rho is not positive"
+        assert  ev_checks(sigma), "sigma is not positive"
     val = (rho*(logM(rho, svd) - logM(sigma, svd))).tr()
     assert abs(val.imag)/(abs(val.real)+1e-8) < 1.e-3, f"imaginary part larger than the tolerance...val={val}"
     return val.real
 
+### batched counterparts of the pairwise distances, used by the *_trajectory error functions
+distance_series = {bures: bures_series, rel_entropy: rel_entropy_series}
+
 # In [14]:
         
-def maxent_rho(rho, basis):   
-    def test(x, rho, basis):
-        k = sum([-u*b for u,b in zip(x, basis)])        
-        sigma = (.5*(k+k.dag())).expm()
-        sigma = sigma/sigma.tr()
-        return rel_entropy(rho, sigma)    
-    res = opt.minimize(test,zeros(len(basis)),args=(rho,basis))
-    k = sum([-u*b for u,b in zip(res.x, basis)])        
-    sigma = (.5*(k+k.dag())).expm()
-    sigma = sigma/sigma.tr()
+### Max-ent fits. For sigma(x) = exp(K(x))/Z(x), with K(x) = -sum_i x_i b_i (b_i the Hermitian parts of the basis 
+### elements), the relative entropy S(rho||sigma(x)) = tr(rho log rho) + x.<b>_rho + log Z(x) is convex in x, with
+###    gradient:  <b_i>_rho - <b_i>_sigma,
+###    Hessian:   the Kubo-Mori covariance of b_i, b_j in sigma, sum_kl (b_i)_kl (b_j)_lk f_kl - <b_i>_sigma <b_j>_sigma,
+###               in the eigenbasis of K, with f_kl = (p_k - p_l)/(lambda_k - lambda_l) (p_k if lambda_k = lambda_l).
+### Everything follows from a single eigendecomposition of K(x) per iterate, instead of finite differences over
+### n+1 matrix exponentials and relative entropies.
+
+def kubo_mori_covariance(ops1, ops2, evals, evecs, p):
+    """
+    (n, m) table of Kubo-Mori covariances, sum_kl (A_i)_kl (B_j)_lk f_kl - <A_i> <B_j>, of the stacked ops1 (n, d, d)
+    and ops2 (m, d, d), in the state of weights p over the eigenbasis (evals, evecs) of its generator.
+    """
+    gaps = evals[:, np.newaxis] - evals[np.newaxis, :]
+    degenerate = abs(gaps) < 1e-10
+    f = np.where(degenerate, .5 * (p[:, np.newaxis] + p[np.newaxis, :]), 
+                 (p[:, np.newaxis] - p[np.newaxis, :]) / np.where(degenerate, 1., gaps))
+    rotated1 = evecs.conj().T @ ops1 @ evecs; rotated2 = evecs.conj().T @ ops2 @ evecs
+    means1 = np.einsum("ikk,k->i", rotated1, p); means2 = np.einsum("ikk,k->i", rotated2, p)
+    return ((rotated1.reshape(len(ops1), -1) * f.ravel()) @ rotated2.transpose(0, 2, 1).reshape(len(ops2), -1).T 
+            - np.outer(means1, means2))
+
+class MaxEntFitter(object):
+    
+    def __init__(self, basis):
+        ops = stack_ops(basis)
+        self.dims = flatten_ops(basis)[0].dims
+        self.ops = .5 * (ops + ops.conj().transpose(0, 2, 1))
+        self.n, self.dim = self.ops.shape[:2]
+        self.flat_ops = self.ops.reshape(self.n, -1)
+        self.last_x = None
+        
+    def set_state(self, rho):
+        rho = rho.full() if isinstance(rho, qutip.Qobj) else np.asarray(rho)
+        ### tr(rho b) = sum_kl b_kl rho_lk
+        self.b_rho = (self.flat_ops @ rho.T.ravel()).real
+        p = linalg.eigvalsh(rho)
+        p = p[p > 1e-14]
+        self.neg_entropy = (p * np.log(p)).sum()
+        
+    def eigensystem(self, x):
+        if self.last_x is None or not np.array_equal(x, self.last_x):
+            evals, evecs = linalg.eigh(-np.tensordot(x, self.ops, axes = 1))
+            shift = evals[-1]
+            weights = np.exp(evals - shift)
+            log_Z = shift + np.log(weights.sum())
+            p = weights / weights.sum()
+            sigma = (evecs * p) @ evecs.conj().T
+            b_sigma = (self.flat_ops @ sigma.T.ravel()).real
+            self.last_x = np.array(x)
+            self.last = (evals, evecs, p, log_Z, sigma, b_sigma)
+        return self.last
+    
+    def objective(self, x):
+        """
+        Returns S(rho||sigma(x)) and its gradient.
+        """
+        evals, evecs, p, log_Z, sigma, b_sigma = self.eigensystem(x)
+        return self.neg_entropy + x @ self.b_rho + log_Z, self.b_rho - b_sigma
+    
+    def hessian(self, x):
+        evals, evecs, p, log_Z, sigma, b_sigma = self.eigensystem(x)
+        return kubo_mori_covariance(self.ops, self.ops, evals, evecs, p).real
+    
+    def fit(self, rho, x0 = None, hessian = False, tol = 1e-10):
+        """
+        Returns the max-ent state sigma closest to rho, and its multipliers x. 
+        x0 (eg. the multipliers of the previous time step) warm-starts the search.
+        """
+        self.set_state(rho)
+        x0 = np.zeros(self.n) if x0 is None else np.asarray(x0, dtype = float)
+        if hessian:
+            res = opt.minimize(self.objective, x0, jac = True, hess = self.hessian, method = "trust-exact", 
+                               tol = tol)
+        else:
+            res = opt.minimize(self.objective, x0, jac = True, method = "BFGS", tol = tol)
+        sigma = self.eigensystem(res.x)[4]
+        return qutip.Qobj(sigma, dims = self.dims), res.x
+        
+def maxent_rho(rho, basis, x0 = None, hessian = False, return_multipliers = False):   
+    sigma, x = MaxEntFitter(basis).fit(rho, x0, hessian)
+    if return_multipliers:
+        return sigma, x
     return sigma
+
+def maxent_trajectory(rhos, basis, hessian = False):
+    """
+    Max-ent states of the states in rhos, each fit warm-started from the multipliers of the previous one.
+    """
+    fitter = MaxEntFitter(basis)
+    sigmas = []; multipliers = []; x = None
+    for rho in rhos:
+        sigma, x = fitter.fit(rho, x, hessian)
+        sigmas.append(sigma); multipliers.append(x)
+    return sigmas, np.array(multipliers)
  
 def error_maxent_state(rho, basis, distance=bures):
     try:
@@ -608,6 +1438,12 @@ def error_maxent_state(rho, basis, distance=bures):
     except:
         print("fail error max-ent state")
         return None
+
+def error_maxent_trajectory(rhos, basis, distance=bures, hessian = False):
+    sigmas, multipliers = maxent_trajectory(rhos, basis, hessian)
+    if distance in distance_series:
+        return distance_series[distance](rhos, sigmas)
+    return np.array([distance(rho, sigma) for rho, sigma in zip(rhos, sigmas)])
        
 def error_proj_state(rho, rho0, basis, distance=bures):
     try:
@@ -625,6 +1461,21 @@ def error_proj_state(rho, rho0, basis, distance=bures):
     except:
         print("fail error proj state")
         return None
+
+def error_proj_trajectory(rhos, rho0, basis, sc_prod = HS_inner_prod_r, distance = bures):
+    """
+    Distances between the states in rhos and the max-ent states exp(P log rho)/Z, with P the projector onto the
+    span of the basis (orthonormalized with respect to rho0 once for the whole trajectory). 
+    """
+    projector = BasisProjector(base_orth(basis, rho0, sc_prod, False), rho0, sc_prod)
+    states = stack_states(rhos); m, dim = states.shape[:2]
+    coeffs = batched_matrix_function(states, np.log).reshape(m, dim * dim) @ projector.duals.T
+    K = (coeffs @ projector.basis).reshape(m, dim, dim)
+    sigmas = batched_matrix_function(K, lambda evals: np.exp(evals - evals.max(axis = -1, keepdims = True)))
+    sigmas = sigmas / np.trace(sigmas, axis1 = 1, axis2 = 2).real[:, np.newaxis, np.newaxis]
+    if distance in distance_series:
+        return distance_series[distance](states, sigmas)
+    return np.array([distance(rho, qutip.Qobj(sigma, dims = projector.dims)) for rho, sigma in zip(rhos, sigmas)])
     
 # In [15]:
 
@@ -653,11 +1504,63 @@ def legacy_classical_ops(n, Hamiltonian):
     Tomix = sum((k-n/2)*(spin_ops_list[3][k] + .5 * spin_ops_list[0][0]) for k in range(n-1))
     return None
 
+### Sparse construction of the classical observables. When the sz operators are diagonal (as in one_body_spin_ops), 
+### so are x_op and n_oc_op, and all the commutators with them act elementwise on the sparse Hamiltonian:
+###    p_op    = i[x, H],          p_ij = i (x_i - x_j) H_ij,
+###    comm_xp = .5 {x, p},        .5 (x_i + x_j) p_ij,
+###    corr_xp = -i[x, p],         (x_i - x_j)^2 H_ij,
+### and only p_dot = i[H, p] = i(Hp - (Hp)^dag) needs a (sparse) matrix product. With x real, all of them are 
+### Hermitian as soon as H is, so Hermiticity is checked once, on the sparse Hamiltonian.
+
+def sparse_isherm(op, tol = 1e-10):
+    diff = (op - op.conj().T).tocsr()
+    diff.eliminate_zeros()
+    return diff.nnz == 0 or abs(diff.data).max() < tol
+
+def scale_entries(op, factor):
+    """
+    Returns the sparse matrix with entries op_ij * factor(i, j), factor acting on arrays of row and column indices.
+    """
+    op = op.tocoo()
+    return sparse.csr_matrix((op.data * factor(op.row, op.col), (op.row, op.col)), shape = op.shape)
+
+def sparse_classical_ops(Hamiltonian, N, op_list, centered_x_op = False):
+    identity_op = op_list[0][0]; sz_list = op_list[3]    
+    labels = ["identity_op", "x_op", "p_op", "n_oc_op", "comm_xp", "corr_xp", "p_dot", "n_oc_disp"]
+    occupations = [sparse_data(sz).diagonal().real + .5 for sz in sz_list]
+    if centered_x_op:
+        x = sum(occupations[k]*(k+1) for k in range(len(sz_list)))
+    else:
+        x = sum((k-N/2)*occupations[k] for k in range(len(sz_list)-1))
+    n_oc = sum(occupations[k] for k in range(len(sz_list)-1))
+    
+    H = sparse_data(Hamiltonian)
+    p = scale_entries(H, lambda i, j: 1j * (x[i] - x[j]))
+    H_p = (H @ p).tocsr()
+    ops = {"x_op": sparse.diags(x), "p_op": p, "n_oc_op": sparse.diags(n_oc), 
+           "comm_xp": scale_entries(p, lambda i, j: .5 * (x[i] + x[j])),
+           "corr_xp": scale_entries(H, lambda i, j: (x[i] - x[j])**2),
+           "p_dot": 1j * (H_p - H_p.conj().T), "n_oc_disp": sparse.diags((n_oc - 1.)**2)}
+    
+    isherm = sparse_isherm(H)
+    if not isherm:
+        for label in ("p_op", "comm_xp", "corr_xp", "p_dot"):
+            print(label, "not hermitian")
+    cl_ops = {"identity_op": identity_op}
+    for label in labels[1:]:
+        cl_ops[label] = qutip.Qobj(ops[label].tocsr(), dims = Hamiltonian.dims, 
+                                   isherm = isherm or label in ("x_op", "n_oc_op", "n_oc_disp"))
+    return cl_ops, labels
+
 def classical_ops(Hamiltonian, N, op_list, centered_x_op = False):
     
     identity_op = op_list[0][0]; sz_list = op_list[3]    
     labels = ["identity_op", "x_op", "p_op", "n_oc_op", "comm_xp", "corr_xp", "p_dot", "n_oc_disp"]
     
+    ### the sparse, elementwise, construction applies whenever the sz operators are diagonal
+    if all(ObservableSet.is_diagonal(sparse_data(sz)) for sz in sz_list):
+        return sparse_classical_ops(Hamiltonian, N, op_list, centered_x_op)
+    
     cl_ops = {"identity_op": identity_op}
     if centered_x_op:
         cl_ops["x_op"] = sum((.5 + sz_list[k])*(k+1) for k in range(len(sz_list)))
@@ -678,6 +1581,439 @@ def classical_ops(Hamiltonian, N, op_list, centered_x_op = False):
             print(labels[i], "not hermitian")
     return cl_ops, labels
     
+### Stacked observables. tr(rho O) = sum_kl rho_kl O_lk = vec(rho) . vec(O^T), so, with the vec(O^T) of all the 
+### observables stacked as the rows of one sparse (n, d^2) matrix, the averages of a state are a single sparse 
+### matrix-vector product, and those of a stacked trajectory (m, d, d) a single sparse-dense matrix product. 
+### Diagonal observables (eg. x_op, n_oc_op) are kept apart, as their diagonals, and only read the diagonal of rho. 
+
+class ObservableSet(object):
+    
+    def __init__(self, obs):
+        obs = flatten_ops(obs)
+        self.n = len(obs); self.dims = obs[0].dims; self.dim = obs[0].shape[0]
+        self.isherm = all(op.isherm for op in obs)
+        diagonal = [k for k, op in enumerate(obs) if self.is_diagonal(sparse_data(op))]
+        self.diagonal_idx = np.array(diagonal, dtype = int)
+        self.general_idx = np.array([k for k in range(self.n) if k not in diagonal], dtype = int)
+        self.diagonals = np.array([sparse_data(obs[k]).diagonal() for k in diagonal]).reshape(len(diagonal), self.dim)
+        rows = []; cols = []; vals = []
+        for row, k in enumerate(self.general_idx):
+            op = sparse_data(obs[k]).tocoo()
+            ### O_lk sits at the flat position k d + l of vec(O^T)
+            rows.append(np.full(op.nnz, row)); cols.append(op.col * self.dim + op.row); vals.append(op.data)
+        self.stacked = sparse.csr_matrix((np.concatenate(vals) if vals else np.zeros(0, complex), 
+                                          (np.concatenate(rows) if rows else np.zeros(0, int), 
+                                           np.concatenate(cols) if cols else np.zeros(0, int))), 
+                                         shape = (len(self.general_idx), self.dim**2))
+        self.obs = obs
+        
+    @staticmethod
+    def is_diagonal(op):
+        op = op.tocoo()
+        return bool(np.all(op.row[op.data != 0] == op.col[op.data != 0]))
+    
+    def __len__(self):
+        return self.n
+    
+    def output(self, values):
+        return values.real if self.isherm else values
+    
+    def expect(self, rho):
+        """
+        Averages of all the observables in rho (Qobj, array, LowRankState or SectorBlocks).
+        """
+        if isinstance(rho, (LowRankState, SectorBlocks)):
+            return self.output(np.array([rho.expect(op) for op in self.obs], dtype = complex))
+        rho = rho.full() if isinstance(rho, qutip.Qobj) else np.asarray(rho)
+        values = np.zeros(self.n, dtype = complex)
+        values[self.diagonal_idx] = self.diagonals @ rho.diagonal()
+        values[self.general_idx] = self.stacked @ rho.ravel()
+        return self.output(values)
+    
+    def trajectory(self, rhos):
+        """
+        (m, n) array of averages along a trajectory of m states (see stack_states).
+        """
+        rhos = stack_states(rhos); m = len(rhos)
+        values = np.zeros((m, self.n), dtype = complex)
+        values[:, self.diagonal_idx] = np.diagonal(rhos, axis1 = 1, axis2 = 2) @ self.diagonals.T
+        values[:, self.general_idx] = (self.stacked @ rhos.reshape(m, -1).T).T
+        return self.output(values)
+
+### Symmetry-sector decomposition. The XX, XXX, XXZ and Anderson chains conserve the total magnetization Sz, and so 
+### do the spin_dephasing collapse operators. With closed boundary conditions (and a uniform Zeeman field) the chains 
+### are also invariant under the cyclic shift of the sites. The evolution of a density matrix then splits into 
+### independent blocks rho_ab = V_a^dag rho V_b, V_a being an isometry onto the conserved-quantity sector a.
+### Symmetries are detected on the sparse Hamiltonian itself, rather than inferred from the chain type. 
+
+def cyclic_shift_states(states, size):
+    ### site n -> n+1 (site N-1 -> 0), with site n stored in bit size-1-n
+    return (states >> 1) | ((states & 1) << (size - 1))
+
+def conserves_magnetization(op, size):
+    op = sparse.coo_matrix(sparse_data(op))
+    op.eliminate_zeros()
+    popcounts = bit_counts(np.arange(2**size))
+    return bool(np.all(popcounts[op.row] == popcounts[op.col]))
+
+def is_translation_invariant(op, size, tol = 1e-10):
+    op = sparse.csr_matrix(sparse_data(op))
+    states = np.arange(2**size)
+    shift = sparse.csr_matrix((np.ones(2**size), (cyclic_shift_states(states, size), states)), 
+                              shape = (2**size, 2**size))
+    residual = shift @ op - op @ shift
+    return residual.nnz == 0 or abs(residual).max() < tol
+
+def symmetry_sectors(Hamiltonian, size, translation = False):
+    """
+    Returns a list of (label, V_a) pairs, V_a being a sparse isometry (2^N x d_a) onto each sector of the conserved
+    magnetization (and, if translation is set, of the lattice momentum 2 pi m/N). Falls back to a single 
+    sector if the Hamiltonian does not have the corresponding symmetry, with a warning. Note that the Zeeman term of
+    Heisenberg_Hamiltonian only acts on sites 0...N-2, so chains with a non-null field are not translation invariant. 
+    """
+    dim = 2**size
+    states = np.arange(dim)
+    if not conserves_magnetization(Hamiltonian, size):
+        warnings.warn("The Hamiltonian does not conserve Sz, no sector decomposition used")
+        return [(("full",), sparse.identity(dim, dtype = complex, format = "csr"))]
+    if translation and not is_translation_invariant(Hamiltonian, size):
+        warnings.warn("The Hamiltonian is not translation invariant (a non-null Zeeman field only acts on sites "
+                      "0...N-2), only Sz sectors used")
+        translation = False
+    
+    popcounts = bit_counts(states)
+    sectors = []
+    for magnetization in range(size + 1):
+        sector_states = states[popcounts == magnetization]
+        if not translation:
+            V = sparse.csr_matrix((np.ones(len(sector_states), dtype = complex), 
+                                   (sector_states, np.arange(len(sector_states)))), shape = (dim, len(sector_states)))
+            sectors.append((("Sz", .5 * size - magnetization), V))
+            continue
+        
+        ### Orbits of the cyclic shift. |r, k> = p^(-1/2) sum_j exp(-i k j) T^j |r>, with p the period of the 
+        ### representative r, only exists for momenta k = 2 pi m / N with m p / N integer.
+        
+        orbits = []; visited = set()
+        for state in sector_states:
+            if state in visited:
+                continue
+            orbit = [state]
+            shifted = cyclic_shift_states(state, size)
+            while shifted != state:
+                orbit.append(shifted)
+                shifted = cyclic_shift_states(shifted, size)
+            visited.update(orbit)
+            orbits.append(orbit)
+        
+        for m in range(size):
+            rows = []; cols = []; values = []; column = 0
+            for orbit in orbits:
+                period = len(orbit)
+                if (m * period) % size:
+                    continue
+                k = 2 * np.pi * m / size
+                rows += orbit; cols += [column] * period
+                values += [np.exp(-1j * k * j)/np.sqrt(period) for j in range(period)]
+                column += 1
+            if column:
+                V = sparse.csr_matrix((values, (rows, cols)), shape = (dim, column))
+                sectors.append((("Sz, k", .5 * size - magnetization, m), V))
+    return sectors
+
+class SectorEvolution(object):
+    """
+    Evolves density matrices block by block, over the symmetry sectors of a Hamiltonian. The sector Hamiltonians 
+    are diagonalized once (closed evolution), or the block Liouvillians are built once per pair of sectors 
+    (open evolution, with collapse operators that do not mix the sectors).
+    """
+    def __init__(self, Hamiltonian, sectors, c_ops = None):
+        self.dims = Hamiltonian.dims
+        self.sectors = sectors
+        self.V = sparse.hstack([V for label, V in sectors], format = "csr")
+        self.offsets = np.cumsum([0] + [V.shape[1] for label, V in sectors])
+        self.H_blocks = self.sector_operators(Hamiltonian)
+        self.c_op_blocks = [self.sector_operators(c_op) for c_op in c_ops] if c_ops else None
+        self.eigensystems = {}; self.liouvillians = {}; self.op_sectors = {}
+    
+    def block_slice(self, a):
+        return slice(self.offsets[a], self.offsets[a+1])
+    
+    def sector_operators(self, op):
+        ### Diagonal blocks V_a^dag op V_a of a sector-preserving operator
+        op_sectors = (self.V.conj().T @ sparse_data(op) @ self.V).tocsr()
+        op_blocks = [op_sectors[self.block_slice(a), self.block_slice(a)] for a in range(len(self.sectors))]
+        off_blocks = op_sectors - sparse.block_diag(op_blocks, format = "csr")
+        assert off_blocks.nnz == 0 or abs(off_blocks).max() < 1e-10, "Operator mixes the symmetry sectors"
+        return op_blocks
+    
+    def split(self, rho, tol = 1e-14):
+        """
+        Block form V_a^dag rho V_b of rho, keeping only the blocks with entries above tol. Since H and the collapse 
+        operators do not mix the sectors, blocks that are null initially stay null, so a block-diagonal rho never 
+        carries the off-diagonal blocks.
+        """
+        if isinstance(rho, qutip.Qobj):
+            rho = rho.full()
+        n = len(self.sectors)
+        rho_V = [rho @ V for label, V in self.sectors]
+        blocks = {}
+        for a, (label, V_a) in enumerate(self.sectors):
+            for b in range(n):
+                block = V_a.conj().T @ rho_V[b]
+                if block.size and abs(block).max() > tol:
+                    blocks[(a, b)] = block
+        return SectorBlocks(self, blocks)
+    
+    def reassemble(self, blocks):
+        rho = np.zeros((self.V.shape[0],) * 2, dtype = complex)
+        for (a, b), block in blocks.blocks.items():
+            V_a = self.sectors[a][1]; V_b = self.sectors[b][1]
+            rho += V_a @ (V_b.conj() @ block.T).T
+        return qutip.Qobj(rho, dims = self.dims)
+    
+    def operator_sectors(self, op):
+        ### V^dag op V, with the blocks of all the pairs of sectors; computed once per operator
+        if id(op) not in self.op_sectors:
+            self.op_sectors[id(op)] = (op, (self.V.conj().T @ sparse_data(op) @ self.V).tocsr())
+        return self.op_sectors[id(op)][1]
+    
+    def propagator(self, a, t):
+        if a not in self.eigensystems:
+            self.eigensystems[a] = linalg.eigh(self.H_blocks[a].toarray())
+        evals, evecs = self.eigensystems[a]
+        return (evecs * np.exp(-1j * evals * t)) @ evecs.conj().T
+    
+    def block_liouvillian(self, a, b):
+        ### Column-stacking convention, vec(A X B) = (B^T kron A) vec(X), as in qutip 
+        if (a, b) not in self.liouvillians:
+            H_a = self.H_blocks[a]; H_b = self.H_blocks[b]
+            id_a = sparse.identity(H_a.shape[0], format = "csr"); id_b = sparse.identity(H_b.shape[0], format = "csr")
+            L = -1j * (sparse.kron(id_b, H_a) - sparse.kron(H_b.T, id_a))
+            for c_op in self.c_op_blocks:
+                c_a = c_op[a]; c_b = c_op[b]
+                L = L + (sparse.kron(c_b.conj(), c_a) - .5 * sparse.kron(id_b, c_a.conj().T @ c_a) 
+                         - .5 * sparse.kron((c_b.conj().T @ c_b).T, id_a))
+            self.liouvillians[(a, b)] = L.tocsc()
+        return self.liouvillians[(a, b)]
+    
+    def evolve(self, blocks, t):
+        if self.c_op_blocks is None:
+            propagators = {a: self.propagator(a, t) for a in {a for pair in blocks.blocks for a in pair}}
+        new_blocks = {}
+        for (a, b), block in blocks.blocks.items():
+            if self.c_op_blocks is None:
+                new_blocks[(a, b)] = propagators[a] @ block @ propagators[b].conj().T
+            else:
+                new_block = sparse.linalg.expm_multiply(t * self.block_liouvillian(a, b), block.ravel(order = "F"))
+                new_blocks[(a, b)] = new_block.reshape(block.shape, order = "F")
+        return SectorBlocks(self, new_blocks)
+
+class SectorBlocks(object):
+    """
+    Operator in the block form of a SectorEvolution, {(a, b): V_a^dag rho V_b}, the missing blocks being null. 
+    Averages are read from the blocks, tr(rho O) = sum_ab tr(rho_ab O_ba), and the full operator is only built by 
+    full / to_qobj.
+    """
+    def __init__(self, evolution, blocks):
+        self.evolution = evolution; self.blocks = blocks
+        self.dims = evolution.dims
+    
+    def tr(self):
+        return sum(np.trace(block) for (a, b), block in self.blocks.items() if a == b)
+    
+    def expect(self, op):
+        op_sectors = self.evolution.operator_sectors(op)
+        value = 0.
+        for (a, b), block in self.blocks.items():
+            op_ba = op_sectors[self.evolution.block_slice(b), self.evolution.block_slice(a)]
+            value += op_ba.multiply(block.T).sum()
+        return value.real if abs(value.imag) < 1e-12 * max(1., abs(value)) else value
+    
+    def full(self):
+        return self.evolution.reassemble(self).full()
+    
+    def to_qobj(self):
+        return self.evolution.reassemble(self)
+
+### Lindblad Liouvillians for diagonal collapse operators (eg. spin_dephasing). In the column-stacking 
+### vectorization, L = -i (I x H - H^T x I) + diag(vec(D)), since for diagonal c_k the dissipator acts elementwise,
+###    D_ij = sum_k c_k(i) conj(c_k(j)) - .5 (|c_k(i)|^2 + |c_k(j)|^2),
+### which for the sz dephasing of spin_dephasing is -gamma/2 times the number of sites where i and j differ.
+### L is then only as dense as the two Kronecker products of H. spin_chain_ev builds it once per run, for all the
+### chunks, and runs with an OperatorCache share it through the cache. If H is also diagonal, the evolution is exact and elementwise, rho_ij(t) = exp(t (-i (E_i - E_j) + D_ij)) rho_ij (see 
+### KrylovPropagator).
+
+def dephasing_rates(c_ops, dim):
+    rates = np.zeros((dim, dim))
+    for c_op in c_ops:
+        c = sparse_data(c_op).diagonal()
+        rates = rates + (np.outer(c, c.conj()) - .5 * (abs(c)[:, np.newaxis]**2 + abs(c)[np.newaxis, :]**2)).real
+    return rates
+
+def lindblad_liouvillian(Hamiltonian, c_ops):
+    """
+    Sparse (column-stacking) Liouvillian, as qutip.liouvillian(Hamiltonian, c_ops).data.
+    """
+    if not all(ObservableSet.is_diagonal(sparse_data(c_op)) for c_op in c_ops):
+        return sparse_data(qutip.liouvillian(Hamiltonian, c_ops)).tocsr()
+    H = sparse_data(Hamiltonian); dim = H.shape[0]
+    identity = sparse.identity(dim, format = "csr")
+    return (-1j * (sparse.kron(identity, H) - sparse.kron(H.T, identity)) 
+            + sparse.diags(dephasing_rates(c_ops, dim).ravel(order = "F"))).tocsr()
+
+### Krylov propagation between checkpoints. qutip.mesolve is restarted on every deltat chunk and integrates through
+### `sampling` internal points, which are then discarded. Here the state is advanced straight to the next checkpoint
+### with the action of the exponential (scipy's expm_multiply) on the state:
+###    * closed evolution: U X U^dag = (U (U X)^dag)^dag, with U X = expm_multiply(-i H t, X) acting on the columns, 
+###    * open evolution: vec(rho(t)) = expm_multiply(L t, vec(rho)), with the (column-stacking) Liouvillian L built
+###      once (see lindblad_liouvillian) and reused across all the chunks,
+###    * diagonal H and collapse operators: the exact elementwise evolution rho_ij exp(rates_ij t).
+
+class KrylovPropagator(object):
+    
+    def __init__(self, Hamiltonian, c_ops = None, liouvillian = None):
+        self.dims = Hamiltonian.dims
+        self.closed = not c_ops
+        self.rates = None
+        H = sparse_data(Hamiltonian)
+        if ObservableSet.is_diagonal(H) and all(ObservableSet.is_diagonal(sparse_data(c_op)) for c_op in (c_ops or [])):
+            energies = H.diagonal()
+            self.rates = -1j * (energies[:, np.newaxis] - energies[np.newaxis, :].conj())
+            if c_ops:
+                self.rates = self.rates + dephasing_rates(c_ops, len(energies))
+        elif self.closed:
+            self.generator = (-1j * H).tocsr()
+        else:
+            self.generator = liouvillian if liouvillian is not None else lindblad_liouvillian(Hamiltonian, c_ops)
+    
+    def step(self, rho, t):
+        qutip_form = isinstance(rho, qutip.Qobj)
+        if qutip_form:
+            rho = rho.full()
+        if self.rates is not None:
+            rho = rho * np.exp(t * self.rates)
+        elif self.closed:
+            U_rho = sparse.linalg.expm_multiply(t * self.generator, rho)
+            rho = sparse.linalg.expm_multiply(t * self.generator, U_rho.conj().T).conj().T
+        else:
+            vec_rho = sparse.linalg.expm_multiply(t * self.generator, rho.ravel(order = "F"))
+            rho = vec_rho.reshape(rho.shape, order = "F")
+        if qutip_form:
+            rho = qutip.Qobj(rho, dims = self.dims)
+        return rho
+    
+    def evolve(self, rho, ts):
+        """
+        Returns the states at the times ts (ts[0] being the time of rho), and nothing in between.
+        """
+        states = [rho if ts[0] == 0 else self.step(rho, ts[0])]
+        for dt in np.diff(ts):
+            states.append(self.step(states[-1], dt))
+        return states
+
+### Low-rank states, rho = floor * I + sum_k w_k |psi_k><psi_k|, with the kets stored as the columns of a (d, r) array.
+### The identity part is invariant under unitary evolution and contributes floor * tr(O) to every average, so a closed
+### evolution only needs to propagate the r kets: O(r d) memory instead of O(d^2), and r sparse matrix-vector 
+### Krylov propagations per step instead of dense d x d products. This only pays off for r well below d: states 
+### whose rank (above the floor) exceeds state_vectors_max_rank_fraction * d are evolved as density matrices.
+
+state_vectors_max_rank_fraction = .25
+
+class LowRankState(object):
+    
+    def __init__(self, weights, kets, floor = 0., dims = None):
+        self.kets = np.asarray(kets, dtype = complex).reshape(len(kets), -1)
+        self.weights = np.asarray(weights, dtype = float).reshape(-1)
+        assert len(self.weights) == self.kets.shape[1], "one weight per ket is needed"
+        self.floor = float(floor)
+        self.dim = self.kets.shape[0]
+        self.dims = dims if dims is not None else [[self.dim], [self.dim]]
+        self.truncation_error = 0.
+        
+    @classmethod
+    def from_ket(cls, psi, weight = 1., floor = 0.):
+        return cls([weight], psi.full(), floor, [psi.dims[0], psi.dims[0]])
+    
+    @staticmethod
+    def spectrum_cut(evals, rank_tol = 1e-8, max_rank = None):
+        """
+        Returns the floor, the lowest eigenvalue (if positive), and the indices of the eigenvalues that stand above it 
+        by more than rank_tol (relative to the largest one), in increasing order of eigenvalue.
+        """
+        floor = max(evals.min(), 0.)
+        keep = np.nonzero(evals - floor > rank_tol * max(evals.max(), 0.))[0]
+        keep = keep[np.argsort(evals[keep], kind = "stable")]
+        if max_rank is not None:
+            keep = keep[len(keep) - max_rank:] if max_rank < len(keep) else keep
+        return floor, keep
+    
+    @classmethod
+    def from_density_op(cls, rho, rank_tol = 1e-8, max_rank = None, eigensystem = None):
+        """
+        Keeps the eigenvectors of rho whose eigenvalues stand above the floor (see spectrum_cut). The trace norm of 
+        the discarded part is stored in truncation_error. eigensystem may be a HermitianEigensystem of rho already
+        computed. 
+        """
+        eigsys = eigensystem if eigensystem is not None else HermitianEigensystem(rho)
+        evals, evecs = eigsys.evals, eigsys.evecs
+        floor, keep = cls.spectrum_cut(evals, rank_tol, max_rank)
+        excess = evals - floor
+        state = cls(excess[keep], evecs[:, keep], floor, rho.dims)
+        state.truncation_error = abs(excess).sum() - excess[keep].sum()
+        return state
+    
+    @classmethod
+    def from_product_state(cls, rho, rank_tol = 1e-8, max_rank = None):
+        """
+        As from_density_op, for a ProductState: the eigenvectors are tensor products of those of the factors, so 
+        only the kept kets are ever built, from the decompositions of the factors.
+        """
+        site_eigensystems = rho.eigensystems()
+        evals = rho.eigenvalues()
+        floor, keep = cls.spectrum_cut(evals, rank_tol, max_rank)
+        excess = evals - floor
+        digits = np.unravel_index(keep, rho.dims[0])
+        kets = np.ones((1, len(keep)), dtype = complex)
+        for eigsys, site_digits in zip(site_eigensystems, digits):
+            kets = (kets[:, np.newaxis, :] * eigsys.evecs[:, site_digits][np.newaxis, :, :]).reshape(-1, len(keep))
+        state = cls(excess[keep], kets, floor, rho.dims)
+        state.truncation_error = abs(excess).sum() - excess[keep].sum()
+        return state
+    
+    @property
+    def rank(self):
+        return len(self.weights)
+    
+    def tr(self):
+        return self.weights.sum() + self.floor * self.dim
+    
+    def expect(self, op):
+        if isinstance(op, qutip.Qobj):
+            tr_op = op.tr()
+            op = sparse_data(op)
+        else:
+            tr_op = op.diagonal().sum()
+        components = np.einsum("ij,ij->j", self.kets.conj(), op @ self.kets)
+        value = components @ self.weights + self.floor * tr_op
+        return value.real if abs(value.imag) < 1e-12 * max(1., abs(value)) else value
+    
+    def evolve(self, Hamiltonian, t):
+        """
+        Returns the state evolved with exp(-i H t), H being a Qobj or a sparse matrix.
+        """
+        kets = sparse.linalg.expm_multiply(-1j * t * sparse_data(Hamiltonian).tocsr(), self.kets)
+        state = LowRankState(self.weights, kets, self.floor, self.dims)
+        state.truncation_error = self.truncation_error
+        return state
+        
+    def full(self):
+        return ((self.kets * self.weights) @ self.kets.conj().T 
+                + self.floor * np.eye(self.dim))
+    
+    def to_qobj(self):
+        return qutip.Qobj(self.full(), dims = self.dims)
+
 HS_modified = True
 
 class Result(object):
@@ -687,58 +2023,100 @@ class Result(object):
         self.projrho0_app = None   
         self.projrho_inst_app = None 
 
-rhos = []    
-def callback_A(t, rhot):
-    global rho
-    global rhos
-    rho = rhot
-    rhos.append(rhot)
-    
+@with_profiler
+@with_operator_memo
 def spin_chain_ev(size, init_state, chain_type, closed_bcs, Hamiltonian_paras, omega_1=3., omega_2=3., temp=1, tmax = 250, deltat = 10, 
                   two_body_basis = True, unitary_ev = False, gamma = 1*np.e**-2,
-                  gaussian = True, gr = 2, xng = .5, sc_prod = HS_inner_prod_r, obs_basis = None, do_project = True):
+                  gaussian = True, gr = 2, xng = .5, sc_prod = HS_inner_prod_r, obs_basis = None, do_project = True,
+                  use_symmetries = None, solver = "mesolve", state_vectors = False, cache = None, sink = None,
+                  disorder_seed = None, recursive_basis_seeds = None):
+    
+    ### use_symmetries = "magnetization" or "translation" evolves the state block by block over the conserved-quantity
+    ### sectors of the Hamiltonian (see symmetry_sectors). Translation sectors are only used in closed evolutions, 
+    ### since the spin_dephasing collapse operators are not translation invariant. Fallbacks to fewer sectors are 
+    ### warned about, and the kind of sectors actually used ("full", "Sz" or "Sz, k") is recorded in ev_parameters.
+    ### solver = "krylov" advances the state from one deltat checkpoint to the next with KrylovPropagator, instead 
+    ### of restarting qutip.mesolve with `sampling` internal points on every chunk. 
+    ### state_vectors = True evolves the significant eigenvectors of rho0 (see LowRankState) instead of the density
+    ### matrix. It requires a closed, non-projected evolution, and accepts a ket as init_state. States of too high 
+    ### a rank fall back to the density-matrix path, with a warning (see state_vectors_max_rank_fraction).
+    ### cache (an OperatorCache or a directory) stores the spin operators, Hamiltonian, observables and basis, 
+    ### so that repeated runs sharing them skip the setup stage.
+    ### profiler (a StageProfiler, see with_profiler) times every stage of the run, and attaches its report to 
+    ### ev_parameters as "Timing report".
+    ### operator_memo (an OperatorMemo, see with_operator_memo) shares the memoized spin operators between runs; by 
+    ### default each run memoizes its own.
+    ### sink (see ResultSink) receives the averages and states step by step. By default, they are kept in memory,
+    ### states only for projected evolutions.
+    ### disorder_seed seeds the Anderson disorder (see anderson_disorder), so that the run can be reproduced and its 
+    ### Hamiltonian cached.
+    ### recursive_basis_seeds, a list of (depth, op) pairs, projects onto the orthonormal recursive basis of 
+    ### lanczos_recursive_basis, built from the seeds and the Hamiltonian, instead of the n-body max_ent_basis.
     
     build_all = True
     
+    last_state = [None]
     def callback_t(t, rhot):
-        global rho
-        rho = rhot
+        last_state[0] = rhot
     
     sc_prod = HS_inner_prod_r
     ### The algorithm starts by constructing all one-body spin operators, acting on the full N-particle Hilbert space
     ### This means, it constructs the 3N + 1 one_body spins ops (N sigmax operators, N sigmay operators, N sigmaz operators
     ### an the global identity operator
     
-    spin_big_list = one_body_spin_ops(size)
-    loc_globalid = one_body_spin_ops(size)[0][0]
+    if cache is not None and not isinstance(cache, OperatorCache):
+        cache = OperatorCache(cache)
+    
+    with profile_stage("operator build"):
+        ### operators loaded from the cache replace the memoized ones, which the other factories are keyed on
+        spin_big_list = register_memoized_ops(("one_body_spin_ops", size), 
+                                              cached(cache, ("one_body_spin_ops", size), 
+                                                     lambda: one_body_spin_ops(size)))
     
     #Jx = Hamiltonian_paras[0]; Jy = Hamiltonian_paras[1]
     #Jz = Hamiltonian_paras[2]; h = Hamiltonian_paras[3] 
     
     ### Then, the algorithm either takes a user-input initial density matrix or it constructs a default one.
     
-    if init_state is None:
-        print("Processing default initial state")
-        rho0 = choose_initial_state_type(spin_big_list, size, build_all, xng, gaussian, gr)
-    else: 
-        print("Processing custom initial state")
-        if (is_density_op(init_state)):
-            rho0 = init_state
-        else:
-            raise Exception("User input initial state not a density matrix")
+    if state_vectors and (do_project or not unitary_ev):
+        raise ValueError("state_vectors requires a closed evolution without projections")
+    
+    with profile_stage("initial state"):
+        if init_state is None:
+            print("Processing default initial state")
+            ### the factorized (ProductState) or low-rank forms are kept for the state-vector path, which expands 
+            ### them only if needed
+            rho0 = choose_initial_state_type(spin_big_list, size, build_all, xng, gaussian, gr, lazy = state_vectors)
+        else: 
+            print("Processing custom initial state")
+            if state_vectors and qutip.isket(init_state):
+                rho0 = LowRankState.from_ket(init_state.unit())
+            elif (is_density_op(init_state)):
+                rho0 = init_state
+            else:
+                raise Exception("User input initial state not a density matrix")
     
     ### Hamiltonian
     
-    H=Heisenberg_Hamiltonian(op_list = spin_big_list, chain_type = chain_type,
-                                size = size, Hamiltonian_paras = Hamiltonian_paras,
-                                closed_bcs = closed_bcs, visualization = False)
+    ### unseeded Anderson disorder is drawn anew on every call, so neither it nor what is built from it is cached
+    random_disorder = chain_type == "Anderson" and np.isscalar(Hamiltonian_paras[3]) and disorder_seed is None
+    H_cache = None if random_disorder else cache
+    ### H is written directly in sparse form, without the full-space tensor products of Heisenberg_Hamiltonian
+    H_key = ("sparse_Heisenberg_Hamiltonian", chain_type, size, Hamiltonian_paras, closed_bcs, disorder_seed)
+    with profile_stage("Hamiltonian"):
+        H = cached(H_cache, H_key,
+                   lambda: sparse_Heisenberg_Hamiltonian(chain_type = chain_type, size = size, 
+                                                         Hamiltonian_paras = Hamiltonian_paras, 
+                                                         closed_bcs = closed_bcs, disorder_seed = disorder_seed))
     
     ### Then, the algorithm either takes a user-input choice for observables or it constructs a default one. 
     
     if obs_basis is None: 
         print("Processing default observable basis")
-        cl_ops, labels = classical_ops(H, size, spin_big_list, False)
-        obs = cl_ops #, x_op**2,p_op**2, corr_op, p_dot]
+        with profile_stage("classical_ops"):
+            cl_ops, labels = cached(H_cache, ("classical_ops", H, size), 
+                                    lambda: classical_ops(H, size, spin_big_list, False))
+        obs = [cl_ops[label] for label in labels] #, x_op**2,p_op**2, corr_op, p_dot]
     else:
         print("Processing custom observable basis")
         obs = obs_basis
@@ -756,45 +2134,122 @@ def spin_chain_ev(size, init_state, chain_type, closed_bcs, Hamiltonian_paras, o
         print("Open evolution chosen")
         c_op_list = spin_dephasing(spin_big_list, size, gamma)
         
-    rho = init_state                                                               
-    approx_exp_vals = [[qutip.expect(op, rho) for op in obs]]
-    ts= [0]
+    if state_vectors and not isinstance(rho0, LowRankState):
+        ### the rank is read from the spectrum, before any ket is built; product states are decomposed site by site
+        if isinstance(rho0, ProductState):
+            rho0_eigensystem = None; rho0_evals = rho0.eigenvalues()
+        else:
+            rho0_eigensystem = HermitianEigensystem(rho0); rho0_evals = rho0_eigensystem.evals
+        rank = len(LowRankState.spectrum_cut(rho0_evals)[1])
+        if rank > state_vectors_max_rank_fraction * len(rho0_evals):
+            warnings.warn(f"rho0 has rank {rank} above its floor, out of {len(rho0_evals)}: "
+                          "evolving the density matrix instead of the state vectors")
+            state_vectors = False
+            if isinstance(rho0, ProductState):
+                rho0 = rho0.to_qobj()
+        elif isinstance(rho0, ProductState):
+            rho0 = LowRankState.from_product_state(rho0)
+        else:
+            rho0 = LowRankState.from_density_op(rho0, eigensystem = rho0_eigensystem)
+        
+    with profile_stage("observables"):
+        observables = ObservableSet(obs)
+    def averages(state):
+        return observables.expect(state)
+        
+    if sink is None:
+        sink = ResultSink(keep_states = "all" if do_project else None)
+    sink.open(int(tmax/deltat) + 1, len(obs), H.dims)
+    
+    rho = rho0                                                               
+    sink.append(0, averages(rho))
     
     ### If a projected evolution is desired, then a two-body spin operator basis is chosen. Otherwise, if the exact ev,
     ### is desired, this step will be skipped. 
     
     if do_project:    
         print("Processing two-body for proj ev")
-        basis = max_ent_basis(spin_big_list, two_body_basis, size, rho0, sc_prod)
+        ### rho0 is validated once, and its inner product is reused by the basis construction and the projections
+        with profile_stage("basis orthonormalization"):
+            rho0_sc_prod = HSInnerProduct(rho0, sc_prod)
+            if recursive_basis_seeds is None:
+                basis = cached(cache, ("max_ent_basis", size, two_body_basis, rho0, sc_prod),
+                               lambda: max_ent_basis(spin_big_list, two_body_basis, size, rho0, rho0_sc_prod))
+            else:
+                basis = cached(H_cache, ("lanczos_recursive_basis", recursive_basis_seeds, H, rho0, sc_prod),
+                               lambda: lanczos_recursive_basis(recursive_basis_seeds, H, rho0, rho0_sc_prod)[0])
+            projector = BasisProjector(basis, rho0, rho0_sc_prod)
+    
+    ### In closed projected evolutions the generator log(rho) is evolved instead of rho, since 
+    ### U log(rho) U^dag = log(U rho U^dag). The projection then needs no decomposition of the evolved state.
+    
+    evolve_generator = do_project and unitary_ev
+    sectors_used = None
+    evolved = logM(rho) if evolve_generator else rho
+    
+    if state_vectors:
+        print("Evolving", rho0.rank, "state vectors")
+    elif use_symmetries is not None:
+        if use_symmetries == "translation" and not unitary_ev:
+            warnings.warn("Translation sectors are not used in open evolutions, only Sz sectors used")
+        sectors = symmetry_sectors(H, size, translation = (use_symmetries == "translation" and unitary_ev))
+        print("Evolving over", len(sectors), "symmetry sectors")
+        sectors_used = sectors[0][0][0]
+        sector_ev = SectorEvolution(H, sectors, c_op_list)
+        ### the state is kept in block form, and only reassembled for the projections
+        evolved = sector_ev.split(evolved)
+        print("Keeping", len(evolved.blocks), "of", len(sectors)**2, "sector blocks")
+    else:
+        ### open evolutions build the Liouvillian once, for all the chunks (and the runs sharing the caches)
+        liouvillian = None
+        if not unitary_ev:
+            with profile_stage("Liouvillian"):
+                liouvillian = cached(H_cache, ("lindblad_liouvillian", H, c_op_list), 
+                                     lambda: lindblad_liouvillian(H, c_op_list))
+        if solver == "krylov":
+            propagator = KrylovPropagator(H, c_op_list, liouvillian)
+        elif liouvillian is not None:
+            generator = qutip.Qobj(liouvillian, dims = [H.dims, H.dims])
+        else:
+            generator = H
     
     for i in range(int(tmax/deltat)):
         ### Heisenberg Hamiltonian is constructed
-        qutip.mesolve(H,
-                               rho0=rho, 
-                               tlist=np.linspace(0,deltat, sampling), 
-                               c_ops=c_op_list, 
-                               e_ops=callback_t,
-                               args={'gamma': gamma,'omega_1': omega_1, 'omega_2': omega_2}
-                               )
-        ts.append(deltat*i)
+        with profile_stage("evolution step"):
+            if state_vectors:
+                evolved = evolved.evolve(H, deltat)
+            elif use_symmetries is not None:
+                evolved = sector_ev.evolve(evolved, deltat)
+            elif solver == "krylov":
+                evolved = propagator.step(evolved, deltat)
+            else:
+                qutip.mesolve(generator,
+                                   rho0=evolved, 
+                                   tlist=np.linspace(0,deltat, sampling), 
+                                   c_ops=[], 
+                                   e_ops=callback_t,
+                                   args={'gamma': gamma,'omega_1': omega_1, 'omega_2': omega_2}
+                                   )
+                evolved = last_state[0]
         if do_project:
-            rho = proj_op(logM(rho), basis, rho0, sc_prod)
-            e0 = max(rho.eigenenergies())
-            rho = rho - loc_globalid * e0
-            rho = rho.expm()
-            trrho = (2.*rho.tr())
-            rho = (rho+rho.dag())/trrho
-            rhos.append(rho)
+            if use_symmetries is not None:
+                evolved = sector_ev.reassemble(evolved)
+            if evolve_generator:
+                rho, phi, evolved = maxent_projection_step(None, projector, log_rho = evolved)
+            else:
+                rho, phi, log_rho = maxent_projection_step(evolved, projector)
+                evolved = rho
+            if use_symmetries is not None:
+                evolved = sector_ev.split(evolved)
+        else:
+            rho = evolved
 
         #print(qutip.entropy.entropy_vn(rho))
-        newobs = [qutip.expect(rho, op) for op in obs]
-        approx_exp_vals.append(newobs)
+        with profile_stage("expect"):
+            newobs = averages(rho)
+        with profile_stage("output"):
+            sink.append(deltat*(i+1), newobs, rho)
         
-    result = {}
-    result["ts"] = ts
-    result["averages"] = np.array(approx_exp_vals)
-    result["State ev"] = rhos
-    
     if unitary_ev:
         title = f"{chain_type}-chain closed ev/Proj ev for N={size} spins" 
     else:
@@ -808,10 +2263,93 @@ def spin_chain_ev(size, init_state, chain_type, closed_bcs, Hamiltonian_paras, o
     ev_parameters = {"no. spins": size, "chain type": chain_type, "Model parameters": Hamiltonian_paras, "Sampling": sampling, 
                      "Two body basis": two_body_basis, "Closed ev": unitary_ev, "Colapse parameters": gamma, 
                      "Gaussian ev": gaussian, "Gaussian order": gr, "Non-gaussian para": xng, "Type of inner product": sc_prod,
-                     "no. observables returned": len(obs), "Proj. ev": do_project}
-    
+                     "no. observables returned": len(obs), "Proj. ev": do_project, 
+                     "Recursive basis": recursive_basis_seeds is not None, "Symmetry sectors": use_symmetries,
+                     "Sectors used": sectors_used,
+                     "Solver": solver, "Disorder seed": disorder_seed,
+                     "State vectors": state_vectors}
+    
+    sink.close(title, ev_parameters)
+    result = sink.result()
     return title, ev_parameters, result
 
+### Parameter sweeps. Each point of the grid is a dict of spin_chain_ev keyword arguments, and is run in its own 
+### worker process. Workers are spawned with the BLAS thread pools pinned (blas_threads per worker), so that 
+### `workers` concurrent runs do not oversubscribe the machine. Every (title, ev_parameters, result) triple is
+### pickled to out_dir as soon as its run finishes (written to a temporary file and renamed, so that a killed sweep 
+### never leaves half-written results), under a name derived from its parameters. Rerunning the same sweep skips 
+### the points whose files already exist.
+
+blas_thread_variables = ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", 
+                         "BLIS_NUM_THREADS", "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS"]
+
+def parameter_grid(**axes):
+    """
+    Cartesian product of the given axes, eg. parameter_grid(size = [4,6], chain_type = ["XX","XYZ"]) 
+    """
+    keys = list(axes.keys())
+    return [dict(zip(keys, values)) for values in itertools.product(*[axes[key] for key in keys])]
+
+def sweep_file_name(params):
+    key = hashlib.sha1(pickle.dumps(sorted(params.items()), protocol = 4)).hexdigest()[:16]
+    name = "-".join(f"{k}={params[k]}" for k in ("chain_type", "size") if k in params)
+    return (name + "-" if name else "") + key + ".pkl"
+
+def sweep_point(params, path):
+    start = time.time()
+    title, ev_parameters, result = spin_chain_ev(**params)
+    ev_parameters["Wall time"] = time.time() - start
+    tmp_path = path + f".{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump((title, ev_parameters, result), f)
+    os.replace(tmp_path, path)
+    return path
+
+def spin_chain_sweep(grid, out_dir, workers = None, blas_threads = 1, resume = True, **common_paras):
+    """
+    Runs spin_chain_ev(**common_paras, **params) for each params in grid over a pool of workers.
+    Returns the list of result files, in grid order (None for the points that failed). 
+    """
+    os.makedirs(out_dir, exist_ok = True)
+    points = [dict(common_paras, **params) for params in grid]
+    paths = [os.path.join(out_dir, sweep_file_name(params)) for params in points]
+    pending = [k for k, path in enumerate(paths) if not (resume and os.path.exists(path))]
+    print(len(points) - len(pending), "of", len(points), "sweep points already done")
+    if not pending:
+        return paths
+    
+    ### spawned workers inherit the environment at start-up, before numpy is imported
+    saved_env = {var: os.environ.get(var) for var in blas_thread_variables}
+    os.environ.update({var: str(blas_threads) for var in blas_thread_variables})
+    try:
+        context = multiprocessing.get_context("spawn")
+        with concurrent.futures.ProcessPoolExecutor(max_workers = workers, mp_context = context) as pool:
+            futures = {pool.submit(sweep_point, points[k], paths[k]): k for k in pending}
+            for future in concurrent.futures.as_completed(futures):
+                k = futures[future]
+                try:
+                    future.result()
+                    print("Finished sweep point", k, ":", paths[k])
+                except Exception as error:
+                    print("Sweep point", k, "failed:", repr(error))
+                    paths[k] = None
+    finally:
+        for var, value in saved_env.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+    return paths
+
+def load_sweep(paths):
+    results = []
+    for path in paths:
+        if path is None:
+            continue
+        with open(path, "rb") as f:
+            results.append(pickle.load(f))
+    return results
+
 # In [16]: 
 
 def build_reference_state(size, temp, Hamiltonian, lagrange_op, lagrange_mult, svd = True):
@@ -841,7 +2379,7 @@ def recursive_basis(depth, Hamiltonian, seed_op, rho0):
                 print("Operator at depth", i, "is null")
                 loc_op = None
                 break
-            loc_op = (loc_op * rho0).tr() - loc_op
+            loc_op = loc_op - (loc_op * rho0).tr()
             basis.append(loc_op)
     elif (depth == 0):
         basis = []
@@ -852,13 +2390,146 @@ def vectorized_recursive_basis(depth_and_ops, Hamiltonian, rho0):
     for depth, op in depth_and_ops: 
         basis_rec += recursive_basis(depth, Hamiltonian, op, rho0)
     return basis_rec
+
+### Lanczos-type (block Arnoldi) construction of the recursive basis. Instead of building the raw iterated 
+### commutators, whose norms grow exponentially with the depth, and orthonormalizing them afterwards, each new 
+### operator -i[H, b_j] is orthogonalized (twice, for stability) against the current basis with the rho0 inner 
+### product and normalized right away. The seeds of depth_and_ops are processed together as one block Krylov space; 
+### a seed of depth d contributes its seed plus d-1 commutators, as in recursive_basis. The identity is included 
+### first, so that all the other operators have null rho0-averages. A residual norm below tol (relative to the
+### norm of the commutator) signals that the Krylov space has closed along that direction. 
+### The coefficients h_ij = sc_prod(b_i, -i[H, b_j]) are collected along the way, and the missing columns (operators
+### at the maximal depth) are completed at the end, so that the returned Htensor equals 
+### H_ij_matrix(Hamiltonian, basis, rho0, sc_prod). 
+
+def lanczos_recursive_basis(depth_and_ops, Hamiltonian, rho0, sc_prod = HS_inner_prod_r, include_identity = True, 
+                            tol = 1e-8):
+    dims = Hamiltonian.dims
+    if not isinstance(sc_prod, HSInnerProduct):
+        sc_prod = HSInnerProduct(rho0, sc_prod, dims)
+    rho0_array = sc_prod.rho0_array; symmetrized = sc_prod.symmetrized
+    H = Hamiltonian.full(); dim = H.shape[0]
+    hermitian = all(qutip.isherm(op) for depth, op in depth_and_ops) and symmetrized
+    
+    def liouvillian(op):
+        return -1j * (H @ op - op @ H)
+    
+    basis = []; remaining_depth = []; h = {}
+    def add_operator(op, depth):
+        ### Orthogonalizes op against the basis; returns the projection coefficients and the residual norm
+        op_norm = np.sqrt(abs(stacked_gram_matrix(op[np.newaxis], op[np.newaxis], rho0_array, symmetrized)[0, 0]))
+        coeffs = np.zeros(len(basis), dtype = complex)
+        for k in range(2):
+            if basis:
+                alpha = stacked_gram_matrix(np.array(basis), op[np.newaxis], rho0_array, symmetrized)[:, 0]
+                if hermitian:
+                    alpha = alpha.real
+                op = op - np.tensordot(alpha, np.array(basis), axes = 1)
+                coeffs += alpha
+        residual = np.sqrt(abs(stacked_gram_matrix(op[np.newaxis], op[np.newaxis], rho0_array, symmetrized)[0, 0]))
+        if residual > tol * op_norm:
+            if hermitian:
+                op = .5 * (op + op.conj().T)
+            basis.append(op/residual); remaining_depth.append(depth)
+        return coeffs, residual
+    
+    if include_identity:
+        add_operator(np.identity(dim, dtype = complex), 0)
+    for depth, op in depth_and_ops:
+        if depth > 0:
+            add_operator(op.full(), depth - 1)
+    
+    j = 0
+    while j < len(basis):
+        if remaining_depth[j] > 0:
+            n_before = len(basis)
+            coeffs, residual = add_operator(liouvillian(basis[j]), remaining_depth[j] - 1)
+            h[j] = np.concatenate([coeffs, [residual] if len(basis) > n_before else []])
+            if len(basis) == n_before:
+                print("Krylov space closed at operator", j)
+        j += 1
+    
+    n = len(basis); stacked_basis = np.array(basis)
+    Htensor = np.zeros((n, n), dtype = complex)
+    for j in range(n):
+        if j in h:
+            Htensor[:len(h[j]), j] = h[j]
+        else:
+            Htensor[:, j] = stacked_gram_matrix(stacked_basis, liouvillian(basis[j])[np.newaxis], 
+                                                rho0_array, symmetrized)[:, 0]
+    return [qutip.Qobj(op, dims = dims) for op in basis], Htensor
+    
     
 # In [17]:
 
-def H_ij_matrix(Hamiltonian, basis, rho0, sc_prod):
+def H_ij_matrix(Hamiltonian, basis, rho0, sc_prod, vectorized = False):
+    
+    ### vectorized = True evaluates each commutator once, on the stacked basis (see vectorized_H_ij_matrix). 
+    ### Bases of Pauli strings, with a Pauli-string Hamiltonian, use the Pauli algebra instead (pauli_H_ij_matrix).
+    
+    if all(isinstance(op, (PauliString, PauliSum)) for op in list(basis) + [Hamiltonian]):
+        return pauli_H_ij_matrix(Hamiltonian, basis, rho0, sc_prod)
+    if vectorized:
+        return vectorized_H_ij_matrix(Hamiltonian, basis, rho0, sc_prod)
     coeffs_matrix = np.array([[sc_prod(op1, -1j * commutator(Hamiltonian, op2), rho0) for op2 in basis] for op1 in basis])
     return coeffs_matrix
 
+### The n commutators -i[H, b_j] are evaluated at once on the stacked (n, d, d) basis, with two matrix products, 
+### and H_ij = sc_prod(b_i, -i[H, b_j]) is then a single cross Gram matrix between the basis and the commutators. 
+
+def vectorized_H_ij_matrix(Hamiltonian, basis, rho0, sc_prod):
+    basis = flatten_ops(basis)
+    if not isinstance(sc_prod, HSInnerProduct):
+        sc_prod = HSInnerProduct(rho0, sc_prod, basis[0].dims)
+    stacked_basis = stack_ops(basis); n, dim = stacked_basis.shape[:2]
+    H = Hamiltonian.full()
+    H_basis = (H @ stacked_basis.transpose(1, 0, 2).reshape(dim, n * dim)).reshape(dim, n, dim).transpose(1, 0, 2)
+    basis_H = (stacked_basis.reshape(n * dim, dim) @ H).reshape(n, dim, dim)
+    commutators = -1j * (H_basis - basis_H)
+    return stacked_gram_matrix(stacked_basis, commutators, sc_prod.rho0_array, sc_prod.symmetrized)
+
+### Structure-constant path for Pauli-string bases. The commutators, and the products b_i^dag [H, b_j], are 
+### evaluated in the Pauli algebra, and the inner products reduce to averages of single Pauli strings,
+###        tr(rho0 X^x Z^z) = sum_j (-1)^|z&j| rho0[j, j^x],
+### which only involve the entries of rho0 (for rho0 = None, the maximally mixed state, just the identity term 
+### survives). No 2^N x 2^N operator is built. 
+
+def pauli_expectation(x, z, rho0_array, size):
+    if rho0_array is None:
+        return 1. if (x == 0 and z == 0) else 0.
+    states = np.arange(2**size)
+    return ((1. - 2. * parity(z & states)) * rho0_array[states, states ^ x]).sum()
+
+def pauli_H_ij_matrix(Hamiltonian, basis, rho0, sc_prod):
+    size = Hamiltonian.size
+    if isinstance(sc_prod, HSInnerProduct):
+        symmetrized = sc_prod.symmetrized
+        rho0_array = None if sc_prod.rho0 is None else sc_prod.rho0_array
+    else:
+        symmetrized = sc_prod is HS_inner_prod_r
+        if rho0 is None:
+            rho0_array = None
+        else:
+            assert is_density_op(rho0, verbose=True), "rho0 is not a density op"
+            rho0_array = rho0.full()
+    
+    averages = {}
+    def average(op):
+        result = 0.
+        for (x, z), c in op.terms.items():
+            if (x, z) not in averages:
+                averages[(x, z)] = pauli_expectation(x, z, rho0_array, size)
+            result += c * averages[(x, z)]
+        return result
+    
+    basis = [op if isinstance(op, PauliSum) else PauliSum.from_string(op) for op in basis]
+    basis_dag = [op.dag() for op in basis]
+    commutators = [-1j * (Hamiltonian * op - op * Hamiltonian) for op in basis]
+    if symmetrized:
+        return np.array([[.5 * average(op1 * op2 + op2 * op1) for op2 in commutators] for op1 in basis_dag])
+    return np.array([[average(op1 * op2) for op2 in commutators] for op1 in basis_dag])
+
+
 def basis_orthonormality_check(basis, rho0, sc_prod): 
 
     dim = len(basis)
@@ -907,27 +2578,107 @@ def visz_H_tensor_evs(Htensor):
     ax1.legend(loc=0)
     ax1.set_title("H-tensor's eigenvalues' real and imag part")
 
+### Coefficient-space evolution. In the projected dynamics the coefficient vector phi of K = -sum_i phi_i b_i obeys
+### d phi/dt = Htensor phi, so phi(t) = exp(t Htensor) phi0. Htensor is diagonalized once, and phi(t) is obtained 
+### for all the requested times with a single vectorized product. If Htensor is (numerically) defective, the 
+### propagation falls back to Krylov steps (expm_multiply) between consecutive times. States are only built when 
+### they are asked for. 
+
+class LazyStates(object):
+    ### Sequence of states exp(K(t))/tr exp(K(t)), each one built when indexed.
+    def __init__(self, engine, phis):
+        self.engine = engine; self.phis = phis
+    
+    def __len__(self):
+        return len(self.phis)
+    
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return self.engine.state(self.phis[i])
+
+class PhiEvolution(object):
+    
+    def __init__(self, Htensor, basis = None, max_condition = 1e10):
+        Htensor = np.real_if_close(np.asarray(Htensor))
+        self.Htensor = Htensor
+        evals, evecs = linalg.eig(Htensor)
+        if np.linalg.cond(evecs) < max_condition:
+            self.method = "eig"
+            self.evals = evals; self.evecs = evecs; self.inv_evecs = linalg.inv(evecs)
+        else:
+            print("Htensor is close to defective, using Krylov propagation")
+            self.method = "krylov"
+        self.basis = None
+        if basis is not None:
+            basis = flatten_ops(basis)
+            self.dims = basis[0].dims
+            stacked_basis = stack_ops(basis)
+            self.dim = stacked_basis.shape[1]
+            self.basis = stacked_basis.reshape(len(basis), self.dim**2)
+    
+    def phis(self, phi0, ts):
+        """
+        Returns the (len(ts), n) array of coefficient vectors phi(t) = exp(t Htensor) phi0.
+        """
+        phi0 = np.asarray(phi0); ts = np.asarray(ts)
+        if self.method == "eig":
+            phis = (np.exp(np.outer(ts, self.evals)) * (self.inv_evecs @ phi0)) @ self.evecs.T
+        else:
+            phis = [sparse.linalg.expm_multiply(ts[0] * self.Htensor, phi0)]
+            for dt in np.diff(ts):
+                phis.append(sparse.linalg.expm_multiply(dt * self.Htensor, phis[-1]))
+            phis = np.array(phis)
+        if np.isrealobj(self.Htensor) and np.isrealobj(phi0):
+            phis = phis.real
+        return phis
+    
+    def require_basis(self):
+        if self.basis is None:
+            raise ValueError("PhiEvolution was built without a basis, which states and averages require")
+    
+    def generator(self, phi):
+        self.require_basis()
+        return -(np.asarray(phi) @ self.basis).reshape(self.dim, self.dim)
+    
+    def state(self, phi):
+        K = self.generator(phi)
+        non_hermiticity = np.linalg.norm(K - K.conj().T)
+        if non_hermiticity > 1e-10 * max(np.linalg.norm(K), 1.):
+            print("Non hermitician part norm:", non_hermiticity)
+            assert False, "K is not Hermitician "
+        K_eigensystem = HermitianEigensystem(K)
+        rhot = K_eigensystem.expm(shift = K_eigensystem.evals[-1])
+        return qutip.Qobj(rhot/np.trace(rhot).real, dims = self.dims)
+    
+    def states(self, phi0, ts):
+        return LazyStates(self, self.phis(phi0, ts))
+    
+    def first_order_averages(self, obs, phis, phi_ref, rho0):
+        """
+        First-order approximation of the averages of the observables along phis, around the state of coefficients 
+        phi_ref (rho0 = state(phi_ref)): since rho ~ exp(-sum_j phi_j b_j), <O> ~ <O>_rho0 - sum_j (phi_j - phi_ref_j) 
+        C(b_j, O), C being the Kubo-Mori covariance in rho0 (see kubo_mori_covariance). The tables of <O>_rho0 and 
+        C(b_j, O) are computed once, from the eigendecomposition of rho0, so the whole trajectory is a single matrix 
+        product. It is only reliable close to rho0; exact averages require the states themselves (see states).
+        """
+        self.require_basis()
+        rho0_array = rho0.full() if isinstance(rho0, qutip.Qobj) else np.asarray(rho0)
+        p, evecs = linalg.eigh(.5 * (rho0_array + rho0_array.conj().T))
+        p = np.clip(p, 1e-300, None)
+        mean_table = np.array([qutip.expect(op, rho0) for op in obs])
+        response_table = kubo_mori_covariance(self.basis.reshape(-1, self.dim, self.dim), stack_ops(obs), 
+                                              np.log(p), evecs, p)
+        return np.real_if_close(mean_table - (np.asarray(phis) - np.asarray(phi_ref)) @ response_table)
+
+
 def semigroup_phit_and_rhot_sol(phi0, rho0, Htensor, ts, basis):
-    Phi_vector_solution = []; rho_at_timet = []
+    ### phi(t) is propagated for all the times at once by PhiEvolution, and the states are built from it. 
+    ### As before, the last time in ts is left out.
+    engine = PhiEvolution(Htensor, basis)
     phi0=np.array(phi0)
-    Phi_vector_solution.append(phi0); rho_at_timet.append(rho0)
-    
-    new_phi = Phi_vector_solution[0]
-    for i in range(1, len(ts)-1):
-        evol_op = linalg.expm(ts[i]*Htensor)
-        new_phi = evol_op.dot(phi0)
-        Phi_vector_solution.append(new_phi)
-        K = -sum( f*op for f,op in zip(new_phi, basis))
-        K = K - max(K.eigenenergies()) 
-        # assert K.isherm, "K is not Hermitician "
-        if not K.isherm:
-            print("Non hermitician part norm:", np.linalg.norm( (K-K.dag()).full())  )
-            assert K.isherm, "K is not Hermitician "
-        rhot= K.expm()
-        #if (rhot.tr() < 1e-6):
-        #   continue 
-        rho_at_timet.append(rhot/rhot.tr())
-        #rho_at_timet.append(rhot)
+    Phi_vector_solution = [phi0] + list(engine.phis(phi0, ts[1:len(ts)-1]))
+    rho_at_timet = [rho0] + [engine.state(phi) for phi in Phi_vector_solution[1:]]
     return rho_at_timet, Phi_vector_solution    
 
 def semigroup_rhos_test(rho_list, visualization_nonherm, ts):
@@ -1002,3 +2753,153 @@ def mesolve(H, rho0, tlist, c_ops=None, e_ops=None,**kwargs):
 
     qutip.mesolve(H, rho0, tlist, c_ops, e_ops=callback, **kwargs)
     return result
+
+# In [19]:
+
+### Regression checks. Each of the faster paths above is compared against the baseline it replaces, on a small 
+### chain, and the *_tests functions return a dictionary {check: passed}, printing the failed checks. 
+### regression_tests runs them all.
+
+def random_max_ent_state(op_list, N, seed = 0, scale = .3):
+    ### a generic, full-rank, two-body max-ent state
+    rng = np.random.default_rng(seed)
+    K = sum(scale * rng.normal() * op for op in n_body_basis(op_list, 2, N)[1:])
+    rho0 = (.5 * (K + K.dag())).expm()
+    rho0 = .5 * (rho0 + rho0.dag())
+    return rho0/rho0.tr()
+
+def report_checks(name, checks, start_time, tol = None):
+    for check, passed in checks.items():
+        if not passed:
+            print(name, check, "failed" + ("" if tol is None else f" (tol = {tol})"))
+    if all(checks.values()):
+        print("All", name, "checks passed")
+    print("--- Test concluded in: %s seconds ---" % (time.time() - start_time))
+    return checks
+
+def sparse_Heisenberg_Hamiltonian_tests(N = 4, tol = 1e-10):
+    start_time = time.time()
+    op_list = one_body_spin_ops(N)
+    Hamiltonian_paras = [.2, .15, .1, 1.]
+    checks = {}
+    for chain_type in ["XX", "XYZ", "XXZ", "XXX", "Anderson"]:
+        for closed_bcs in (False, True):
+            H_dense = Heisenberg_Hamiltonian(op_list, chain_type, N, Hamiltonian_paras, closed_bcs, 
+                                             disorder_seed = 1)
+            H_sparse = sparse_Heisenberg_Hamiltonian(chain_type, N, Hamiltonian_paras, closed_bcs, disorder_seed = 1)
+            checks[(chain_type, closed_bcs)] = (H_dense.dims == H_sparse.dims and 
+                                                 np.abs(H_dense.full() - H_sparse.full()).max() < tol)
+    return report_checks("sparse_Heisenberg_Hamiltonian", checks, start_time, tol)
+
+def vectorized_basis_tests(N = 3, tol = 1e-8):
+    start_time = time.time()
+    op_list = one_body_spin_ops(N)
+    rho0 = random_max_ent_state(op_list, N)
+    H = Heisenberg_Hamiltonian(op_list, "XYZ", N, [.2, .15, .1, 1.], True)
+    ops = n_body_basis(op_list, 2, N)
+    checks = {}
+    for sc_prod in (HS_inner_prod_r, HS_inner_prod_t):
+        basis = base_orth(ops, rho0, sc_prod)
+        vectorized_basis = base_orth(ops, rho0, sc_prod, vectorized = True)
+        checks[("base_orth", sc_prod.__name__)] = (
+            len(basis) == len(vectorized_basis) and 
+            max(np.abs(b1.full() - b2.full()).max() for b1, b2 in zip(basis, vectorized_basis)) < tol)
+        
+        bound_sc_prod = HSInnerProduct(rho0, sc_prod, basis[0].dims)
+        gram = np.array([[sc_prod(b1, b2, rho0) for b2 in basis[:8]] for b1 in basis[:8]])
+        checks[("gram_matrix", sc_prod.__name__)] = np.abs(gram - gram_matrix(basis[:8], rho0, bound_sc_prod)).max() < tol
+        
+        H_ij = H_ij_matrix(H, basis, rho0, sc_prod)
+        checks[("H_ij_matrix", sc_prod.__name__)] = np.abs(H_ij - H_ij_matrix(H, basis, rho0, sc_prod, 
+                                                                               vectorized = True)).max() < tol
+        
+    ### Pauli-string bases, against their expanded Qobj forms 
+    pauli_op_list = one_body_pauli_ops(N)
+    pauli_H = Heisenberg_Hamiltonian(pauli_op_list, "XYZ", N, [.2, .15, .1, 1.], True)
+    pauli_basis = n_body_basis(pauli_op_list, 1, N)
+    H_ij = H_ij_matrix(pauli_to_qobj(pauli_H), pauli_to_qobj(pauli_basis), rho0, HS_inner_prod_r)
+    checks["pauli_H_ij_matrix"] = np.abs(H_ij - H_ij_matrix(pauli_H, pauli_basis, rho0, HS_inner_prod_r)).max() < tol
+    return report_checks("vectorized basis", checks, start_time, tol)
+
+def projection_tests(N = 3, tol = 1e-8):
+    start_time = time.time()
+    op_list = one_body_spin_ops(N)
+    rho0 = random_max_ent_state(op_list, N)
+    rho = random_max_ent_state(op_list, N, seed = 1, scale = .5)
+    basis = base_orth(n_body_basis(op_list, 2, N), rho0, HS_inner_prod_r)
+    projector = BasisProjector(basis, rho0, HS_inner_prod_r)
+    checks = {}
+    
+    K = logM(rho)
+    checks["BasisProjector"] = (proj_op(K, basis, rho0, HS_inner_prod_r) - projector(K)).norm() < tol
+    
+    projected_K = proj_op(K, basis, rho0, HS_inner_prod_r)
+    sigma = (projected_K - max(projected_K.eigenenergies()) * op_list[0][0]).expm()
+    sigma = sigma/sigma.tr()
+    checks["maxent_projection_step"] = (maxent_projection_step(rho, projector)[0] - sigma).norm() < tol
+    return report_checks("projection", checks, start_time, tol)
+
+def operator_cache_tests(N = 3):
+    import tempfile
+    start_time = time.time()
+    checks = {}
+    builds = []
+    def builder():
+        builds.append(1)
+        return one_body_spin_ops(N)
+    
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = OperatorCache(cache_dir)
+        built = cached(cache, ("one_body_spin_ops", N), builder)
+        loaded = cached(cache, ("one_body_spin_ops", N), builder)
+        checks["OperatorCache round trip"] = (len(builds) == 1 and all(
+            op1.dims == op2.dims and (op1 - op2).norm() == 0 
+            for ops1, ops2 in zip(built, loaded) for op1, op2 in zip(ops1, ops2)))
+    
+    builds.clear()
+    with OperatorMemo() as memo:
+        ops1 = memoized_ops(("one_body_spin_ops", N), builder)
+        ops2 = memoized_ops(("one_body_spin_ops", N), builder)
+        checks["OperatorMemo round trip"] = (len(builds) == 1 and all(
+            (op1 - op2).norm() == 0 for l1, l2 in zip(ops1, ops2) for op1, op2 in zip(l1, l2)))
+    memoized_ops(("one_body_spin_ops", N), builder)
+    checks["OperatorMemo scope"] = active_operator_memo is None and len(builds) == 2
+    return report_checks("cache", checks, start_time)
+
+def spin_chain_ev_tests(N = 4, tmax = 4, deltat = 1., tol = 1e-5):
+    start_time = time.time()
+    op_list = one_body_spin_ops(N)
+    rho0 = random_max_ent_state(op_list, N)
+    Hamiltonian_paras = [.2, .15, .1, 1.]
+    checks = {}
+    with contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        for unitary_ev in (True, False):
+            for do_project in (False, True):
+                run = functools.partial(spin_chain_ev, N, rho0, "XXZ", True, Hamiltonian_paras, tmax = tmax, 
+                                        deltat = deltat, unitary_ev = unitary_ev, do_project = do_project)
+                reference = run()[2]["averages"]
+                variants = {"krylov": dict(solver = "krylov"), "magnetization": dict(use_symmetries = "magnetization"),
+                            "translation": dict(use_symmetries = "translation")}
+                for name, kwargs in variants.items():
+                    checks[(name, unitary_ev, do_project)] = np.abs(run(**kwargs)[2]["averages"] - reference).max() < tol
+        
+        ### the state-vector path, on a rank-one state over a floor, since full-rank states fall back to the density 
+        ### matrix
+        psi0 = qutip.tensor([qutip.basis(2, 0)] + [qutip.basis(2, 1)] * (N-1))
+        rho0 = .9 * psi0 * psi0.dag() + .1 * op_list[0][0]/2**N
+        run = functools.partial(spin_chain_ev, N, tmax = tmax, chain_type = "XXZ", closed_bcs = True, 
+                                Hamiltonian_paras = Hamiltonian_paras, deltat = deltat, unitary_ev = True, 
+                                do_project = False)
+        reference = run(rho0)[2]["averages"]
+        checks[("state_vectors", True, False)] = np.abs(run(rho0, state_vectors = True)[2]["averages"] - 
+                                                        reference).max() < tol
+    return report_checks("spin_chain_ev", checks, start_time, tol)
+
+def regression_tests():
+    checks = {}
+    for tests in (sparse_Heisenberg_Hamiltonian_tests, vectorized_basis_tests, projection_tests, operator_cache_tests,
+                  spin_chain_ev_tests):
+        checks.update({(tests.__name__,) + (check if isinstance(check, tuple) else (check,)): passed 
+                       for check, passed in tests().items()})
+    return checks
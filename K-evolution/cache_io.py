@@ -0,0 +1,372 @@
+# Operator caching and result storage for auxiliary_library.spin_chain_ev: the on-disk OperatorCache of the setup 
+# stage, and the result sinks that receive the evolution step by step. 
+
+import qutip, os, pickle, hashlib, json
+import numpy as np
+import scipy.sparse as sparse
+
+### Sparse form of the operators. qutip 4 stores the data of a Qobj as a fast_csr_matrix (a scipy CSR matrix), while 
+### qutip 5 wraps it in its own data layer, which is converted here. Sparse matrices are returned as they are.
+
+def sparse_data(op):
+    if not isinstance(op, qutip.Qobj):
+        return op
+    data = op.data
+    if sparse.issparse(data):
+        return data
+    return qutip.data.to(qutip.data.CSR, data).as_scipy()
+
+### Content-addressed on-disk cache for the setup stage of spin_chain_ev (spin operators, Hamiltonians, classical
+### observables, orthonormalized bases). Entries are keyed by the sha256 of a fingerprint of their inputs, and stored
+### in a directory per key: the sparse parts (data, indices, indptr) of every Qobj and sparse matrix, and every 
+### numpy array, go to .npy files, read back memory-mapped, and the structure holding them to a small pickle. Only the
+### arrays and sparse matrices (eg. the Liouvillian) stay memory-mapped: qutip.Qobj copies its data into memory, so 
+### Qobj entries are read in full on every hit. Entries are written to a temporary directory and renamed into place, so that concurrent sweep workers can share a cache. When the total
+### size exceeds max_bytes, the least recently used entries (by modification time, refreshed on every hit) are evicted.
+
+def fingerprint(obj, digest = None):
+    top = digest is None
+    if top:
+        digest = hashlib.sha256()
+    if isinstance(obj, qutip.Qobj):
+        digest.update(repr(("Qobj", obj.dims, obj.shape)).encode())
+        data = sparse_data(obj)
+        for part in (data.data, data.indices, data.indptr):
+            digest.update(np.ascontiguousarray(part).tobytes())
+    elif isinstance(obj, np.ndarray):
+        digest.update(repr(("array", obj.dtype.str, obj.shape)).encode())
+        digest.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, (list, tuple)):
+        digest.update(repr((type(obj).__name__, len(obj))).encode())
+        for item in obj:
+            fingerprint(item, digest)
+    elif isinstance(obj, dict):
+        digest.update(repr(("dict", len(obj))).encode())
+        for key in sorted(obj, key = repr):
+            fingerprint(key, digest)
+            fingerprint(obj[key], digest)
+    elif callable(obj):
+        digest.update(repr(("callable", getattr(obj, "__module__", None), 
+                            getattr(obj, "__qualname__", repr(obj)))).encode())
+    else:
+        digest.update(repr(obj).encode())
+    if top:
+        return digest.hexdigest()
+
+class OperatorCache(object):
+    
+    def __init__(self, cache_dir, max_bytes = 2**30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok = True)
+    
+    def key(self, *parts):
+        return fingerprint(parts)
+    
+    def _save(self, obj, entry_dir, arrays):
+        if isinstance(obj, qutip.Qobj):
+            data = sparse_data(obj)
+            idx = len(arrays)
+            for suffix, part in zip(("data", "indices", "indptr"), (data.data, data.indices, data.indptr)):
+                np.save(os.path.join(entry_dir, f"{idx}_{suffix}.npy"), part)
+            arrays.append(idx)
+            return ("__qobj__", idx, obj.dims, obj.shape)
+        if sparse.issparse(obj):
+            obj = obj.tocsr(); idx = len(arrays)
+            for suffix, part in zip(("data", "indices", "indptr"), (obj.data, obj.indices, obj.indptr)):
+                np.save(os.path.join(entry_dir, f"{idx}_{suffix}.npy"), part)
+            arrays.append(idx)
+            return ("__csr__", idx, obj.shape)
+        if isinstance(obj, np.ndarray):
+            idx = len(arrays)
+            np.save(os.path.join(entry_dir, f"{idx}_array.npy"), obj)
+            arrays.append(idx)
+            return ("__array__", idx)
+        if isinstance(obj, list):
+            return [self._save(item, entry_dir, arrays) for item in obj]
+        if isinstance(obj, tuple):
+            return ("__tuple__", [self._save(item, entry_dir, arrays) for item in obj])
+        if isinstance(obj, dict):
+            return ("__dict__", [(key, self._save(value, entry_dir, arrays)) for key, value in obj.items()])
+        return obj
+    
+    def _load(self, meta, entry_dir):
+        if isinstance(meta, list):
+            return [self._load(item, entry_dir) for item in meta]
+        if isinstance(meta, tuple) and meta and isinstance(meta[0], str):
+            load = lambda name: np.load(os.path.join(entry_dir, name), mmap_mode = "r")
+            if meta[0] == "__qobj__":
+                idx, dims, shape = meta[1:]
+                data = sparse.csr_matrix((load(f"{idx}_data.npy"), load(f"{idx}_indices.npy"), 
+                                          load(f"{idx}_indptr.npy")), shape = shape)
+                return qutip.Qobj(data, dims = dims)
+            if meta[0] == "__csr__":
+                idx, shape = meta[1:]
+                return sparse.csr_matrix((load(f"{idx}_data.npy"), load(f"{idx}_indices.npy"), 
+                                          load(f"{idx}_indptr.npy")), shape = shape)
+            if meta[0] == "__array__":
+                return load(f"{meta[1]}_array.npy")
+            if meta[0] == "__tuple__":
+                return tuple(self._load(item, entry_dir) for item in meta[1])
+            if meta[0] == "__dict__":
+                return {key: self._load(value, entry_dir) for key, value in meta[1]}
+        return meta
+    
+    def load(self, key):
+        """
+        Returns the stored value, or None on a miss.
+        """
+        entry_dir = os.path.join(self.cache_dir, key)
+        try:
+            with open(os.path.join(entry_dir, "meta.pkl"), "rb") as f:
+                meta = pickle.load(f)
+            os.utime(entry_dir)
+            return self._load(meta, entry_dir)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            ### missing, or evicted by another process while being read
+            return None
+    
+    def store(self, key, value):
+        entry_dir = os.path.join(self.cache_dir, key)
+        tmp_dir = entry_dir + f".{os.getpid()}.tmp"
+        os.makedirs(tmp_dir, exist_ok = True)
+        meta = self._save(value, tmp_dir, [])
+        with open(os.path.join(tmp_dir, "meta.pkl"), "wb") as f:
+            pickle.dump(meta, f)
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            ### another process stored the same entry first
+            for name in os.listdir(tmp_dir):
+                os.remove(os.path.join(tmp_dir, name))
+            os.rmdir(tmp_dir)
+        self.evict()
+    
+    def get(self, parts, builder):
+        key = self.key(*parts)
+        value = self.load(key)
+        if value is None:
+            value = builder()
+            self.store(key, value)
+        return value
+    
+    def entries(self):
+        """
+        Returns [(mtime, size in bytes, key)] for the stored entries, oldest first.
+        """
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, key)
+            if key.endswith(".tmp") or not os.path.isdir(entry_dir):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry_dir, name)) for name in os.listdir(entry_dir))
+            entries.append((os.path.getmtime(entry_dir), size, key))
+        return sorted(entries)
+    
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries[:-1]:
+            if total <= self.max_bytes:
+                break
+            entry_dir = os.path.join(self.cache_dir, key)
+            for name in os.listdir(entry_dir):
+                os.remove(os.path.join(entry_dir, name))
+            os.rmdir(entry_dir)
+            total -= size
+
+def cached(cache, parts, builder):
+    """
+    builder() through the cache, or directly when cache is None. cache may also be a directory name.
+    """
+    if cache is None:
+        return builder()
+    if not isinstance(cache, OperatorCache):
+        cache = OperatorCache(cache)
+    return cache.get(parts, builder)
+
+### Result sinks. spin_chain_ev hands every time step to a sink as it is produced: the averages of all the steps, 
+### and the states of the steps after the initial one. ResultSink keeps them in memory, with a retention policy for
+### the states (keep_states = "all", "last", None, or an int k to keep every k-th step). StreamingResultWriter 
+### writes them to preallocated .npy files in a directory (ts, averages, states and state_ts, the times of the 
+### stored states), with a meta.json that records how many rows are valid. The files are flushed after every step, 
+### so that the steps done before a crash can still be read (see StoredResult).
+
+class ResultSink(object):
+    
+    def __init__(self, keep_states = "all"):
+        self.keep_states = keep_states
+        
+    def open(self, n_times, n_obs, dims):
+        self.ts = []; self.averages = []; self.states = []; self.state_ts = []
+        self.dims = dims
+        
+    def keeps(self, step):
+        if self.keep_states is None:
+            return False
+        if isinstance(self.keep_states, int):
+            return step % self.keep_states == 0
+        return True
+    
+    def retain(self, step, t, state):
+        if state is not None and self.keeps(step):
+            if self.keep_states == "last":
+                self.states = []; self.state_ts = []
+            self.states.append(state); self.state_ts.append(t)
+    
+    def append(self, t, averages, state = None):
+        self.retain(len(self.ts), t, state)
+        self.ts.append(t); self.averages.append(averages)
+            
+    def close(self, title = None, ev_parameters = None):
+        pass
+    
+    def result(self):
+        return {"ts": self.ts, "averages": np.array(self.averages), "State ev": self.states, 
+                "State ts": self.state_ts}
+
+class StreamingResultWriter(ResultSink):
+    
+    def __init__(self, path, state_stride = 1, keep_states = None):
+        ### state_stride = k stores every k-th state on disk (None, no states), keep_states is the in-memory policy
+        super().__init__(keep_states)
+        self.path = path
+        self.state_stride = state_stride
+        
+    def open(self, n_times, n_obs, dims):
+        super().open(n_times, n_obs, dims)
+        os.makedirs(self.path, exist_ok = True)
+        self.n_times = n_times; self.n_obs = n_obs
+        self.n_states = (n_times - 1) // self.state_stride if self.state_stride else 0
+        self.count = 0; self.state_count = 0
+        self.files = {}
+        self.meta = {"dims": dims, "n_times": n_times, "n_obs": n_obs, "count": 0, "state_count": 0, 
+                     "state_stride": self.state_stride, "complete": False}
+        self.write_meta()
+        
+    def allocate(self, name, shape, dtype):
+        self.files[name] = np.lib.format.open_memmap(os.path.join(self.path, name + ".npy"), mode = "w+", 
+                                                     dtype = dtype, shape = shape)
+        return self.files[name]
+        
+    def write_meta(self):
+        tmp_path = os.path.join(self.path, f"meta.json.{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.meta, f, default = str)
+        os.replace(tmp_path, os.path.join(self.path, "meta.json"))
+    
+    def append(self, t, averages, state = None):
+        step = self.count
+        self.retain(step, t, state)
+        if step == 0:
+            self.allocate("ts", (self.n_times,), float)
+            self.allocate("averages", (self.n_times, self.n_obs), np.asarray(averages).dtype)
+        self.files["ts"][step] = t
+        self.files["averages"][step] = averages
+        self.files["ts"].flush(); self.files["averages"].flush()
+        if state is not None and self.n_states and step % self.state_stride == 0:
+            state = np.asarray(state.full())
+            if "states" not in self.files:
+                self.allocate("states", (self.n_states,) + state.shape, complex)
+                self.allocate("state_ts", (self.n_states,), float)
+            self.files["states"][self.state_count] = state
+            self.files["state_ts"][self.state_count] = t
+            self.files["states"].flush(); self.files["state_ts"].flush()
+            self.state_count += 1
+        self.count = step + 1
+        self.meta.update(count = self.count, state_count = self.state_count)
+        self.write_meta()
+        
+    def close(self, title = None, ev_parameters = None):
+        self.meta.update(title = title, ev_parameters = ev_parameters, complete = True)
+        self.write_meta()
+        self.files = {}
+        
+    def result(self):
+        result = super().result()
+        result["ts"] = np.load(os.path.join(self.path, "ts.npy"), mmap_mode = "r")[:self.count]
+        result["averages"] = np.load(os.path.join(self.path, "averages.npy"), mmap_mode = "r")[:self.count]
+        result["Path"] = self.path
+        return result
+    
+### Reading back the runs stored by StreamingResultWriter. The arrays are memory-mapped and cut to the rows that
+### were completed, so opening a run reads only its meta.json. States are turned into qutip.Qobj (with the 
+### tensor dims of the run) only when they are indexed, and time windows and observables are selected on the 
+### maps, so that only the selected rows are read from disk.
+
+class StoredStates(object):
+    
+    def __init__(self, states, ts, dims):
+        self.states = states; self.ts = ts; self.dims = dims
+    
+    def __len__(self):
+        return len(self.ts)
+    
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return StoredStates(self.states[k], self.ts[k], self.dims)
+        return qutip.Qobj(np.asarray(self.states[k]), dims = self.dims)
+    
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self[k]
+            
+    def array(self, k):
+        """
+        The k-th state as a read-only view of the map, without building a Qobj.
+        """
+        return self.states[k]
+    
+class StoredResult(object):
+    
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.dims = self.meta["dims"]; self.title = self.meta.get("title")
+        self.ev_parameters = self.meta.get("ev_parameters")
+        self.complete = self.meta["complete"]
+        ### a run stopped before its first step has a meta.json, but no arrays yet
+        dim = int(np.prod(self.dims[0]))
+        self.ts = self.load("ts", self.meta["count"], (0,), float)
+        self.averages = self.load("averages", self.meta["count"], (0, self.meta["n_obs"]), float)
+        self.states = StoredStates(self.load("states", self.meta["state_count"], (0, dim, dim), complex), 
+                                   self.load("state_ts", self.meta["state_count"], (0,), float), self.dims)
+    
+    def load(self, name, count, empty_shape, dtype):
+        file_name = os.path.join(self.path, name + ".npy")
+        if count == 0 or not os.path.exists(file_name):
+            return np.zeros(empty_shape, dtype = dtype)
+        return np.load(file_name, mmap_mode = "r")[:count]
+        
+    def __len__(self):
+        return len(self.ts)
+    
+    @staticmethod
+    def window(ts, t0, t1):
+        ### ts is sorted, so the window is a slice of the map
+        start = 0 if t0 is None else np.searchsorted(ts, t0, side = "left")
+        stop = len(ts) if t1 is None else np.searchsorted(ts, t1, side = "right")
+        return slice(start, stop)
+    
+    def averages_between(self, t0 = None, t1 = None, obs = None):
+        """
+        Returns (ts, averages) for t0 <= t <= t1, restricted to the observables obs (an index, list or slice).
+        """
+        window = self.window(self.ts, t0, t1)
+        averages = self.averages[window]
+        if obs is not None:
+            averages = averages[:, obs]
+        return np.asarray(self.ts[window]), np.asarray(averages)
+    
+    def states_between(self, t0 = None, t1 = None):
+        return self.states[self.window(self.states.ts, t0, t1)]
+    
+    def state_at(self, t):
+        """
+        The stored state closest to time t.
+        """
+        return self.states[int(np.argmin(abs(np.asarray(self.states.ts) - t)))]
+    
+def load_stored_results(paths):
+    return [StoredResult(path) for path in paths]
@@ -0,0 +1,249 @@
+# Pauli-string algebra for spin chains, used by auxiliary_library (see one_body_spin_ops(pauli_strings = True) and 
+# pauli_H_ij_matrix). 
+
+import qutip
+import numpy as np
+import scipy.sparse as sparse
+
+### Compact representation of spin operators as Pauli strings. A Pauli string on an N-site chain is stored as 
+### two integer bit masks (x, z), an integer phase p (mod 4) and a complex coefficient c, and stands for the operator 
+###                        c * i**p * X^x Z^z,     X^x = prod_k (sigmax_k)^(x_k),  Z^z = prod_k (sigmaz_k)^(z_k).
+### Site n is mapped onto bit (size-1-n), so that the bits of an integer j coincide with the labels of the 
+### computational basis state j in the qutip.tensor ordering. Products, adjoints and traces are evaluated in closed form
+### and the 2^N x 2^N matrices are only built when explicitly requested (to_qobj, full). 
+
+def popcount(n):
+    return bin(n).count("1")
+
+def bit_counts(states):
+    ### number of set bits of each entry of an integer array
+    states = np.asarray(states)
+    result = np.zeros(states.shape, dtype = int)
+    while np.any(states):
+        result += states & 1
+        states = states >> 1
+    return result
+
+def parity(states):
+    ### bitwise parity of an integer array, evaluated site by site 
+    states = np.asarray(states)
+    result = np.zeros(states.shape, dtype = int)
+    while np.any(states):
+        result ^= states & 1
+        states = states >> 1
+    return result
+
+class PauliString(object):
+    
+    def __init__(self, size, x = 0, z = 0, phase = 0, coeff = 1.):
+        self.size = size
+        self.x = x; self.z = z
+        self.phase = phase % 4
+        self.coeff = complex(coeff)
+    
+    @property
+    def dims(self):
+        return [[2]*self.size, [2]*self.size]
+    
+    def value(self):
+        ### coefficient with the phase folded in 
+        return self.coeff * 1j**self.phase
+    
+    def copy(self):
+        return PauliString(self.size, self.x, self.z, self.phase, self.coeff)
+    
+    def dag(self):
+        ### (i^p X^x Z^z)^dag = i^(-p) Z^z X^x = i^(-p) (-1)^|x&z| X^x Z^z
+        return PauliString(self.size, self.x, self.z, 2 * popcount(self.x & self.z) - self.phase, 
+                           self.coeff.conjugate())
+    
+    def tr(self):
+        if self.x or self.z:
+            return 0.
+        return self.value() * 2**self.size
+    
+    @property
+    def isherm(self):
+        return abs(self.value() - self.dag().value()) < 1e-12
+    
+    def __mul__(self, other):
+        if isinstance(other, PauliString):
+            if self.size != other.size:
+                raise Exception("Incompatible Pauli string sizes")
+            ### Z^z1 X^x2 = (-1)^|z1&x2| X^x2 Z^z1
+            return PauliString(self.size, self.x ^ other.x, self.z ^ other.z, 
+                               self.phase + other.phase + 2 * popcount(self.z & other.x), 
+                               self.coeff * other.coeff)
+        if isinstance(other, PauliSum):
+            return PauliSum.from_string(self) * other
+        if np.isscalar(other):
+            return PauliString(self.size, self.x, self.z, self.phase, self.coeff * other)
+        return NotImplemented
+    
+    def __rmul__(self, other):
+        if np.isscalar(other):
+            return self * other
+        return NotImplemented
+    
+    def __truediv__(self, other):
+        return self * (1./other)
+    
+    def __neg__(self):
+        return self * (-1.)
+    
+    def __add__(self, other):
+        return PauliSum.from_string(self) + other
+    
+    def __radd__(self, other):
+        return PauliSum.from_string(self) + other
+    
+    def __sub__(self, other):
+        return PauliSum.from_string(self) - other
+    
+    def __rsub__(self, other):
+        return (-self) + other
+    
+    def sparse(self):
+        ### X^x Z^z |j> = (-1)^|z&j| |j^x>
+        cols = np.arange(2**self.size)
+        signs = 1. - 2. * parity(self.z & cols)
+        return sparse.csr_matrix((self.value() * signs, (cols ^ self.x, cols)), 
+                                 shape = (2**self.size, 2**self.size))
+    
+    def full(self):
+        return self.sparse().toarray()
+    
+    def to_qobj(self):
+        return qutip.Qobj(self.sparse(), dims = self.dims)
+    
+    def __repr__(self):
+        return f"PauliString(size={self.size}, x={self.x:0{self.size}b}, z={self.z:0{self.size}b}, value={self.value()})"
+
+class PauliSum(object):
+    
+    ### A linear combination of Pauli strings, stored as a dictionary {(x, z): coefficient}, with the phase of
+    ### each string already folded into its coefficient. 
+    
+    def __init__(self, size, terms = None):
+        self.size = size
+        self.terms = dict(terms) if terms is not None else {}
+    
+    @classmethod
+    def from_string(cls, pauli_string):
+        return cls(pauli_string.size, {(pauli_string.x, pauli_string.z): pauli_string.value()})
+    
+    @property
+    def dims(self):
+        return [[2]*self.size, [2]*self.size]
+    
+    def strings(self):
+        return [PauliString(self.size, x, z, 0, c) for (x, z), c in self.terms.items()]
+    
+    def simplify(self, tol = 1e-14):
+        return PauliSum(self.size, {key: c for key, c in self.terms.items() if abs(c) > tol})
+    
+    def copy(self):
+        return PauliSum(self.size, self.terms)
+    
+    def dag(self):
+        return PauliSum(self.size, {(x, z): c.conjugate() * (-1)**popcount(x & z) 
+                                    for (x, z), c in self.terms.items()})
+    
+    def tr(self):
+        return self.terms.get((0, 0), 0.) * 2**self.size
+    
+    @property
+    def isherm(self):
+        herm_terms = self.dag().terms
+        return all(abs(c - herm_terms[key]) < 1e-12 for key, c in self.terms.items())
+    
+    def __add__(self, other):
+        if isinstance(other, PauliString):
+            other = PauliSum.from_string(other)
+        if isinstance(other, PauliSum):
+            if self.size != other.size:
+                raise Exception("Incompatible Pauli string sizes")
+            terms = dict(self.terms)
+            for key, c in other.terms.items():
+                terms[key] = terms.get(key, 0.) + c
+            return PauliSum(self.size, terms)
+        if np.isscalar(other):
+            ### scalars are understood as multiples of the identity, as in sum(...) starting from 0
+            terms = dict(self.terms)
+            if other != 0:
+                terms[(0, 0)] = terms.get((0, 0), 0.) + other
+            return PauliSum(self.size, terms)
+        return NotImplemented
+    
+    __radd__ = __add__
+    
+    def __neg__(self):
+        return self * (-1.)
+    
+    def __sub__(self, other):
+        return self + (-other)
+    
+    def __rsub__(self, other):
+        return (-self) + other
+    
+    def __mul__(self, other):
+        if np.isscalar(other):
+            return PauliSum(self.size, {key: c * other for key, c in self.terms.items()})
+        if isinstance(other, PauliString):
+            other = PauliSum.from_string(other)
+        if isinstance(other, PauliSum):
+            terms = {}
+            for (x1, z1), c1 in self.terms.items():
+                for (x2, z2), c2 in other.terms.items():
+                    key = (x1 ^ x2, z1 ^ z2)
+                    terms[key] = terms.get(key, 0.) + c1 * c2 * (-1)**popcount(z1 & x2)
+            return PauliSum(self.size, terms)
+        return NotImplemented
+    
+    def __rmul__(self, other):
+        if np.isscalar(other):
+            return self * other
+        if isinstance(other, PauliString):
+            return PauliSum.from_string(other) * self
+        return NotImplemented
+    
+    def __truediv__(self, other):
+        return self * (1./other)
+    
+    def sparse(self):
+        dim = 2**self.size
+        result = sparse.csr_matrix((dim, dim), dtype = complex)
+        for pauli_string in self.strings():
+            result = result + pauli_string.sparse()
+        return result
+    
+    def full(self):
+        return self.sparse().toarray()
+    
+    def to_qobj(self):
+        return qutip.Qobj(self.sparse(), dims = self.dims)
+    
+    def __repr__(self):
+        return f"PauliSum(size={self.size}, {len(self.terms)} terms)"
+
+def pauli_to_qobj(op):
+    ### Builds the full-space qutip operator of a Pauli string / Pauli sum. Qobjs are returned untouched. 
+    if isinstance(op, (PauliString, PauliSum)):
+        return op.to_qobj()
+    if isinstance(op, list):
+        return [pauli_to_qobj(loc_op) for loc_op in op]
+    return op
+
+def one_body_pauli_ops(size):
+    
+    ### Pauli-string counterpart of one_body_spin_ops: the same 3N+1 operators, with identical layout, 
+    ### stored as bit masks instead of full tensor products. sy = .5 * sigmay = .5 * i * sigmax sigmaz. 
+    
+    loc_global_id = [PauliString(size)]
+    loc_sx_list = []; loc_sy_list = []; loc_sz_list = []
+    for n in range(size):
+        bit = 1 << (size - 1 - n)
+        loc_sx_list.append(PauliString(size, x = bit, coeff = .5))
+        loc_sy_list.append(PauliString(size, x = bit, z = bit, phase = 1, coeff = .5))
+        loc_sz_list.append(PauliString(size, z = bit, coeff = .5))
+    return loc_global_id, loc_sx_list, loc_sy_list, loc_sz_list